@@ -1,5 +1,6 @@
 import random
-from monte import ISMCTS, AlphaMCTS
+from multiprocessing import Pool
+from monte import ISMCTS, AlphaMCTS, TranspositionTable
 import numpy as np
 
 class Agent:
@@ -11,9 +12,28 @@ class Agent:
         
 class ISMCTSAgent(Agent):
 
-    def __init__(self, iterations=500, rollout_agent=None):
+    def __init__(self, iterations=500, rollout_agent=None, backend="object", workers=1, time_budget_ms=None, min_iterations=1, reuse_tree=False, in_place=False, recorder=None, rollout_moves=None):
+        # iterations may be None when searching for a fixed time_budget_ms per move instead
         self.iterations = iterations
+        self.time_budget_ms = time_budget_ms
+        self.min_iterations = min_iterations
         self.rollout_agent = rollout_agent
+        self.backend = backend
+        # With in_place each search determinizes one copy of the state and undoes its moves instead of cloning
+        # (slower than cloning for the games here, see ISMCTS)
+        self.in_place = in_place
+        # Rollouts longer than rollout_moves are stopped and count as draws
+        self.rollout_moves = rollout_moves
+        # With more than one worker, searches run root-parallel in a process pool kept for the agent's lifetime
+        self.workers = workers
+        self.pool = None
+        # With reuse_tree the search tree is kept between moves and followed down the moves observed in the game
+        self.reuse_tree = reuse_tree
+        self.tree = None
+        self.tree_state = None
+        self.tree_player = None
+        # Training samples from each search go to recorder (a dataset.SampleWriter) when one is given
+        self.recorder = recorder
 
     def GetMove(self, state, moves=None):
         if not moves:
@@ -21,26 +41,71 @@ class ISMCTSAgent(Agent):
         #if len(moves) == 1:
             #print(f"ONLY Move: {moves[0]} \n")
             #return moves[0]
-        m, node = ISMCTS(rootstate = state, itermax = self.iterations, verbose = False, rollout_agent=self.rollout_agent)
+        if self.workers > 1 and self.pool is None:
+            self.pool = Pool(self.workers)
+        rootnode = None
+        if self.tree is not None and self.tree_state is state and self.tree_player == state.playerToMove:
+            rootnode = self.tree
+            rootnode.Detach()
+        m, node = ISMCTS(rootstate = state, itermax = self.iterations, verbose = False, rollout_agent=self.rollout_agent, backend=self.backend, workers=self.workers, pool=self.pool,
+                         time_budget_ms=self.time_budget_ms, min_iterations=self.min_iterations, rootnode=rootnode, in_place=self.in_place,
+                         recorder=self.recorder, rollout_moves=self.rollout_moves)
+        if self.reuse_tree:
+            self.tree = node.parentNode
+            self.tree_state = state
+            self.tree_player = state.playerToMove
         print(f"Best Move: {m} ({(node.wins/node.visits)*100:.1f}%)\n")
         return m, node   
 
+    def ObserveMove(self, state, move):
+        """ Follow a move just made in the game (by any player) down the kept tree.
+            The tree is dropped if the move was never explored or belongs to a different game.
+        """
+        if self.tree is not None:
+            self.tree = self.tree.GetChild(move) if self.tree_state is state else None
+
+    def close(self):
+        """ Shut down the worker pool, if one was started.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __getstate__(self):
+        # Pools can't be pickled; a copy of the agent starts its own when needed
+        state = self.__dict__.copy()
+        state["pool"] = None
+        return state
+
 class AlphaMCTSAgent(Agent):
     
-    def __init__(self, iterations=500, model=None):
+    def __init__(self, iterations=500, model=None, backend="object", batch_size=1, time_budget_ms=None, min_iterations=1, transpositions=0):
+        # iterations may be None when searching for a fixed time_budget_ms per move instead
         self.iterations = iterations
+        self.time_budget_ms = time_budget_ms
+        self.min_iterations = min_iterations
         self.model = model
+        self.backend = backend
+        # Number of leaves evaluated per model call
+        self.batch_size = batch_size
+        # With transpositions > 0, up to that many evaluations are kept between searches and reused
+        self.table = TranspositionTable(transpositions) if transpositions > 0 else None
 
     def GetMove(self, state, moves=None):
-        m, node = AlphaMCTS(rootstate = state, itermax = self.iterations, verbose = False, model = self.model)
+        m, node = AlphaMCTS(rootstate = state, itermax = self.iterations, verbose = False, model = self.model, backend = self.backend, batch_size = self.batch_size,
+                            time_budget_ms = self.time_budget_ms, min_iterations = self.min_iterations, table = self.table)
         print(f"Best Move: {m}  (state value: {(node.parentNode.nn_value)*100:.1f}%)\n")
         return m, node
 
 class RegressionAgent(Agent):
 
-    def __init__(self, first_random=False, verbose=True):
+    def __init__(self, first_random=False, verbose=True, model=None, use_board=True):
         super().__init__()
         self.estimator = None
+        # Evaluates positions instead of estimator.model when set, e.g. a shared InferenceServer
+        self.model = model
+        self.use_board = use_board
         self.verbose = verbose
         self.first_random = first_random
         
@@ -91,7 +156,8 @@ class RegressionAgent(Agent):
         if not self.use_board:
             boards = np.array(inputs)
         
-        predictions = self.estimator.model(boards, training=False)#self.estimator.predict(inputs, verbose=0)       
+        model = self.model if self.model is not None else self.estimator.model
+        predictions = model(boards, training=False)#self.estimator.predict(inputs, verbose=0)       
         if len(inputs) == 1:
             predictions = [predictions]
         for prediction in predictions:
@@ -0,0 +1,384 @@
+import random
+import numpy as np
+from moves import MoveList
+
+_keyed_move_types = {}
+def _MoveKey(move):
+    # Same as monte.MoveKey, kept here so this module does not depend on monte
+    move_type = type(move)
+    keyed = _keyed_move_types.get(move_type)
+    if keyed is None:
+        keyed = _keyed_move_types[move_type] = hasattr(move_type, "key")
+    return move.key() if keyed else move
+
+class ArrayTree:
+    """ A game tree stored as a struct of NumPy arrays instead of a graph of Node objects.
+        Nodes are numbered in the order they are added. The statistics of node i are kept at
+        position slots[i] of the statistic arrays, where the children of a node sit side by side:
+        from first[i], for counts[i] positions. UCB/PUCT selection therefore reads and updates the
+        statistics of all children as slices, without per-node lists or dicts. When a node has
+        more children than the room[i] positions set aside for them, they are moved to the end of
+        the arrays with twice the room. Use ArrayNode (via ArrayTree.root) as a drop-in replacement
+        for monte.Node.
+    """
+    # By position
+    STATS = {
+        "wins": np.float64,
+        "visits": np.float64, # counts, but as floats so selection does not convert them
+        "avails": np.float64,
+        "players": np.int64,
+        "nn_w": np.float64,
+        "nn_q": np.float64,
+        "nn_value": np.float64,
+        "target_value": np.float64,
+        "nn_pred_prob": np.float64,
+        "target_prob": np.float64,
+        "nodes": np.int64, # the node at each position, -1 for an unused one
+    }
+    # By node
+    LINKS = {
+        "parents": np.int64,
+        "slots": np.int64,
+        "first": np.int64,
+        "counts": np.int64,
+        "room": np.int64,
+    }
+    # Positions set aside for the children of a node when it gets its first one
+    CHILD_ROOM = 8
+
+    def __init__(self, capacity=1024):
+        self.size = 0 # positions in use
+        self.capacity = capacity
+        for name, dtype in self.STATS.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.keys = [None] * capacity # by position, the MoveKey of the node's move
+        self.node_count = 0
+        self.node_capacity = capacity
+        for name, dtype in self.LINKS.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.moves = [] # by node
+        self.root = self.AddNode(None, -1, None)
+
+    def AddNode(self, move, parent, playerJustMoved):
+        """ Add a node for move under the parent node and return a view of it.
+            A parent of -1 makes a root node, and a playerJustMoved of None is stored as -1.
+        """
+        if self.node_count == self.node_capacity:
+            self.GrowNodes()
+        index = self.node_count
+        self.node_count += 1
+        key = _MoveKey(move)
+        if parent < 0:
+            position = self.Reserve(1)
+        else:
+            count = int(self.counts[parent])
+            if count == self.room[parent]:
+                self.MoveChildren(parent, max(self.CHILD_ROOM, 2 * count))
+            position = self.first[parent] + count
+            self.counts[parent] = count + 1
+        self.parents[index] = parent
+        self.slots[index] = position
+        self.first[index] = 0
+        self.counts[index] = 0
+        self.room[index] = 0
+        self.moves.append(move)
+        self.keys[position] = key
+        self.nodes[position] = index
+        self.wins[position] = 0
+        self.visits[position] = 0
+        self.avails[position] = 1
+        self.players[position] = -1 if playerJustMoved is None else playerJustMoved
+        self.nn_w[position] = 0
+        self.nn_q[position] = 0
+        self.nn_value[position] = 0
+        self.target_value[position] = 0
+        self.nn_pred_prob[position] = 0
+        self.target_prob[position] = 0
+        return ArrayNode(self, index)
+
+    def Reserve(self, count):
+        """ Return the first of count new positions at the end of the statistic arrays.
+        """
+        start = self.size
+        self.size += count
+        if self.size > self.capacity:
+            self.Grow(self.size)
+        self.nodes[start:self.size] = -1
+        return start
+
+    def MoveChildren(self, index, room):
+        """ Move the children of a node to room new positions at the end of the statistic arrays.
+        """
+        start = self.first[index]
+        count = self.counts[index]
+        new = self.Reserve(room)
+        if count:
+            for name in self.STATS:
+                array = getattr(self, name)
+                array[new:new + count] = array[start:start + count]
+            self.keys[new:new + count] = self.keys[start:start + count]
+            self.slots[self.nodes[new:new + count]] = np.arange(new, new + count)
+            self.nodes[start:start + count] = -1
+        self.first[index] = new
+        self.room[index] = room
+
+    def Grow(self, size):
+        """ Double the capacity of every statistic array until it holds size positions.
+        """
+        while self.capacity < size:
+            self.capacity *= 2
+        for name in self.STATS:
+            old = getattr(self, name)
+            new = np.zeros(self.capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.keys.extend([None] * (self.capacity - len(self.keys)))
+
+    def GrowNodes(self):
+        """ Double the capacity of every per-node array.
+        """
+        self.node_capacity *= 2
+        for name in self.LINKS:
+            old = getattr(self, name)
+            new = np.zeros(self.node_capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def Subtree(self, index):
+        """ Return a new ArrayTree holding a copy of the subtree of a node, with that node as its root.
+            The copy is numbered breadth-first, so every node sits at the position of its number and its
+            children fill exactly the room set aside for them.
+        """
+        old = [index] # the nodes of the subtree in breadth-first order
+        for node in old:
+            start = self.first[node]
+            old.extend(self.nodes[start:start + self.counts[node]].tolist())
+        old = np.array(old, dtype=np.int64)
+        positions = self.slots[old]
+        count = len(old)
+        tree = ArrayTree(max(1024, 2 * count))
+        tree.size = tree.node_count = count
+        for name in self.STATS:
+            getattr(tree, name)[:count] = getattr(self, name)[positions]
+        tree.nodes[:count] = np.arange(count)
+        tree.slots[:count] = np.arange(count)
+        counts = self.counts[old]
+        tree.counts[:count] = counts
+        tree.room[:count] = counts
+        tree.first[:count] = 1 + np.cumsum(counts) - counts
+        tree.parents[0] = -1
+        tree.parents[1:count] = np.repeat(np.arange(count), counts)
+        tree.keys[:count] = [self.keys[position] for position in positions.tolist()]
+        tree.moves = [self.moves[node] for node in old.tolist()]
+        return tree
+
+    def Children(self, index, legalMoves):
+        """ Return the range of positions of the children of a node, and a boolean mask of the ones
+            whose moves are in legalMoves (None if they all are).
+        """
+        start = int(self.first[index])
+        end = start + int(self.counts[index])
+        if isinstance(legalMoves, MoveList):
+            # Look each child up rather than building every move of the list
+            moves = self.moves
+            legal = [moves[child] in legalMoves for child in self.nodes[start:end].tolist()]
+            if all(legal):
+                return start, end, None
+        else:
+            keys = self.keys[start:end]
+            legalKeys = set(map(_MoveKey, legalMoves))
+            if legalKeys.issuperset(keys):
+                return start, end, None
+            legal = [key in legalKeys for key in keys]
+        return start, end, np.array(legal, dtype=bool)
+
+    def ChildKeys(self, index):
+        """ Return the MoveKeys of the moves of the children of a node, in the order of their positions.
+        """
+        start = self.first[index]
+        return self.keys[start:start + self.counts[index]]
+
+    def LegalChildren(self, index, legalMoves):
+        """ Return the nodes of the children of a node whose moves are in legalMoves, as an index array.
+        """
+        start, end, legal = self.Children(index, legalMoves)
+        children = self.nodes[start:end]
+        return children if legal is None else children[legal]
+
+    def Select(self, start, end, legal, scores):
+        """ Return the node at the best scoring legal position in start:end, counting one more availability
+            for every legal child.
+        """
+        if legal is None:
+            best = scores.argmax()
+            self.avails[start:end] += 1
+        else:
+            best = np.where(legal, scores, -np.inf).argmax()
+            self.avails[start:end] += legal
+        return int(self.nodes[start + best])
+
+    def UCBSelect(self, index, legalMoves, exploration):
+        start, end, legal = self.Children(index, legalMoves)
+        visits = self.visits[start:end]
+        scores = self.wins[start:end] / visits + exploration * np.sqrt(np.log(self.avails[start:end]) / visits)
+        return self.Select(start, end, legal, scores)
+
+    def NNSelect(self, index, legalMoves, exploration):
+        start, end, legal = self.Children(index, legalMoves)
+        visits = self.visits[start:end]
+        total = visits.sum() if legal is None else visits[legal].sum()
+        scores = self.nn_q[start:end] + exploration * self.nn_pred_prob[start:end] * np.sqrt(total) / (1 + visits)
+        return self.Select(start, end, legal, scores)
+
+
+def _stat_property(array_name, convert=None):
+    def getter(self):
+        tree = self.tree
+        value = getattr(tree, array_name)[tree.slots[self.index]]
+        return value if convert is None else convert(value)
+
+    def setter(self, value):
+        tree = self.tree
+        getattr(tree, array_name)[tree.slots[self.index]] = value
+
+    return property(getter, setter)
+
+
+class ArrayNode:
+    """ A lightweight view of one node in an ArrayTree, with the same interface as monte.Node.
+    """
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    wins = _stat_property("wins")
+    visits = _stat_property("visits", int)
+    avails = _stat_property("avails", int)
+    nn_w = _stat_property("nn_w")
+    nn_q = _stat_property("nn_q")
+    nn_value = _stat_property("nn_value")
+    target_value = _stat_property("target_value")
+    nn_pred_prob = _stat_property("nn_pred_prob")
+    target_prob = _stat_property("target_prob")
+
+    @property
+    def move(self):
+        return self.tree.moves[self.index]
+
+    @property
+    def playerJustMoved(self):
+        tree = self.tree
+        player = tree.players[tree.slots[self.index]]
+        return None if player < 0 else int(player)
+
+    @property
+    def parentNode(self):
+        parent = int(self.tree.parents[self.index])
+        return None if parent < 0 else ArrayNode(self.tree, parent)
+
+    @property
+    def childNodes(self):
+        tree = self.tree
+        start = tree.first[self.index]
+        return [ArrayNode(tree, child) for child in tree.nodes[start:start + tree.counts[self.index]].tolist()]
+
+    def GetUntriedMoves(self, legalMoves):
+        """ Return the elements of legalMoves for which this node does not have children.
+        """
+        triedKeys = set(self.tree.ChildKeys(self.index))
+        return [move for move in legalMoves if _MoveKey(move) not in triedKeys]
+
+    def GetUntriedMove(self, legalMoves):
+        """ Return a random element of legalMoves for which this node does not have a child, or None if there is none,
+            drawing it directly while most moves are untried (see monte.RandomUntriedMove).
+        """
+        triedKeys = set(self.tree.ChildKeys(self.index))
+        size = len(legalMoves)
+        if size > 2 * len(triedKeys):
+            for attempt in range(4):
+                move = legalMoves[random.randrange(size)]
+                if _MoveKey(move) not in triedKeys:
+                    return move
+        untriedMoves = [move for move in legalMoves if _MoveKey(move) not in triedKeys]
+        return random.choice(untriedMoves) if untriedMoves else None
+
+    def UCBSelectChild(self, legalMoves, exploration = 0.7):
+        """ Use the UCB1 formula over the legal children, vectorized over the slice of their statistics.
+        """
+        return ArrayNode(self.tree, self.tree.UCBSelect(self.index, legalMoves, exploration))
+
+    def NNSelectChild(self, legalMoves, exploration = 0.7):
+        return ArrayNode(self.tree, self.tree.NNSelect(self.index, legalMoves, exploration))
+
+    def AddChild(self, m, p):
+        """ Add a new child node for the move m.
+            Return the added child node
+        """
+        return self.tree.AddNode(m, self.index, p)
+
+    def GetChild(self, move):
+        """ Return the child node for move, or None if it has not been expanded.
+        """
+        tree = self.tree
+        keys = tree.ChildKeys(self.index)
+        key = _MoveKey(move)
+        if key not in keys:
+            return None
+        return ArrayNode(tree, int(tree.nodes[tree.first[self.index] + keys.index(key)]))
+
+    def GetLegalChildren(self, legalMoves):
+        """ Return the children of this node whose moves are in legalMoves.
+        """
+        return [ArrayNode(self.tree, child) for child in self.tree.LegalChildren(self.index, legalMoves).tolist()]
+
+    def Detach(self):
+        """ Make this node the root of its own tree, so a later search can continue from it.
+            Its subtree is copied into the fresh arrays of a new ArrayTree (see ArrayTree.Subtree) and this view
+            moves to it, so the rest of the old tree is freed once nothing else refers to it.
+        """
+        self.tree = self.tree.Subtree(self.index)
+        self.index = 0
+
+    def Update(self, terminalState):
+        """ Increment the visit count by one, and increase the win count by the result of terminalState for playerJustMoved.
+        """
+        tree = self.tree
+        position = tree.slots[self.index]
+        tree.visits[position] += 1
+        player = tree.players[position]
+        if player >= 0:
+            tree.wins[position] += terminalState.GetResult(int(player))
+
+    def __eq__(self, other):
+        return isinstance(other, ArrayNode) and other.tree is self.tree and other.index == self.index
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return f"[M:{self.move} W/Q/V/P:  {self.nn_value:4.1f} / {self.nn_q:4.1f} / {self.visits:4} / {self.nn_pred_prob:4.1f}"
+
+    def TreeToString(self, indent):
+        """ Represent the tree as a string, for debugging purposes.
+        """
+        s = self.IndentString(indent) + str(self)
+        for c in self.childNodes:
+            s += c.TreeToString(indent+1)
+        return s
+
+    def IndentString(self,indent):
+        s = "\n"
+        for i in range (1,indent+1):
+            s += "| "
+        return s
+
+    def ChildrenToString(self):
+        s = ""
+        for c in self.childNodes:
+            s += str(c) + "\n"
+        return s
@@ -30,8 +30,15 @@ class ChessState(GameState):
         self.board.push_san(move)
         self.playerToMove = self.GetNextPlayer(self.playerToMove)
     
-    def UndoMove(self):
+    def DoUndoableMove(self, move):
+        token = self.playerToMove
+        self.DoMove(move)
+        return token
+
+    def UndoMove(self, token=None):
         self.board.pop()
+        if token is not None:
+            self.playerToMove = token
     
     def GetMoves(self):
         if self.board.is_checkmate() or self.board.is_insufficient_material() or self.board.is_game_over():
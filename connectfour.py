@@ -1,4 +1,4 @@
-from monte import GameState, SelfPlayGame, PlayGame, get_model
+from monte import GameState, SelfPlayGame, PlayGame, get_model, ZobristKey
 from agents import Agent, ISMCTSAgent, AlphaMCTSAgent, RegressionAgent
 import random
 from copy import copy, deepcopy
@@ -21,6 +21,38 @@ def diagonalsNeg (matrix, cols, rows):
     for di in ([(j, i - cols + j + 1) for j in range(cols)] for i in range(cols + rows - 1)):
         yield [matrix[i][j] for i, j in di if i >= 0 and j >= 0 and i < cols and j < rows]
 
+def mirror_inputs(inputs):
+    """ Mirror boards left to right: inputs is one board or a batch of them, as flat to_inputs() rows
+        or as 6x7x1 images.
+    """
+    inputs = np.asarray(inputs)
+    if inputs.shape[-1] == 1:
+        return inputs[..., ::-1, :]
+    return inputs.reshape(inputs.shape[:-1] + (6, 7))[..., ::-1].reshape(inputs.shape)
+
+def mirror_policy(policy):
+    """ Mirror a prior per column (or a batch of them) left to right. """
+    return policy[..., ::-1] if isinstance(policy, np.ndarray) else policy[::-1]
+
+def canonical_sample(inputs, policy=None):
+    """ Return (inputs, policy) for one board and its prior per column, mirrored when the mirrored board
+        is the smaller of the two, so a position and its mirror image are stored as the same sample.
+    """
+    inputs = np.asarray(inputs)
+    mirrored = mirror_inputs(inputs)
+    differ = np.flatnonzero(inputs.reshape(-1) != mirrored.reshape(-1))
+    if len(differ) == 0 or inputs.flat[differ[0]] < mirrored.flat[differ[0]]:
+        return inputs, policy
+    return mirrored, None if policy is None else mirror_policy(np.asarray(policy))
+
+def augment_batch(inputs, targets):
+    """ Add the mirror image of every sample of a training batch: targets are the value and the prior per
+        column, as in a get_model() dataset. The returned batch is twice the size.
+    """
+    mirrored = targets.copy()
+    mirrored[:, 1:] = targets[:, :0:-1]
+    return np.concatenate([inputs, mirror_inputs(inputs)]), np.concatenate([targets, mirrored])
+
 class ConnectFourState(GameState):
     
     MOVE_ZONE_PHASE = 0
@@ -36,6 +68,12 @@ class ConnectFourState(GameState):
         self.rows = 6
         self.win = 4
         self.board = [[NONE] * self.rows for _ in range(self.cols)]
+        # Zobrist hash of the discs on the board, updated as they are inserted and undone
+        self.hash = 0
+        # and the hash of the board mirrored left to right
+        self.mirror_hash = 0
+        # Colour of the line of four on the board, if any; also kept up to date by insert and UndoMove
+        self.winner = None
 
     def Clone(self):
         """ Create a deep clone of this game state.
@@ -47,7 +85,10 @@ class ConnectFourState(GameState):
         st.rows = self.rows
         st.win = self.win
         
-        st.board = deepcopy(self.board)
+        st.board = [column[:] for column in self.board]
+        st.hash = self.hash
+        st.mirror_hash = self.mirror_hash
+        st.winner = self.winner
 
         return st
     
@@ -72,7 +113,43 @@ class ConnectFourState(GameState):
         self.playerToMove = self.GetNextPlayer(self.playerToMove)
         return self
 
-    
+    def DoUndoableMove(self, move):
+        """ Carry out the given move like DoMove, and return a token that UndoMove can use to take it back.
+        """
+        token = (move, self.playerToMove)
+        self.DoMove(move)
+        return token
+
+    def UndoMove(self, token):
+        """ Restore the state from before the DoUndoableMove call that returned token.
+        """
+        column, self.playerToMove = token
+        c = self.board[column]
+        # The disc played last is the topmost one in its column
+        i = 0
+        while c[i] == NONE:
+            i += 1
+        self.hash ^= ZobristKey("disc", column, i, c[i])
+        self.mirror_hash ^= ZobristKey("disc", self.cols - 1 - column, i, c[i])
+        c[i] = NONE
+        # No move can be made once the game is won, so the board was undecided before this one
+        self.winner = None
+
+    def DoRandomRollout(self, max_moves=None):
+        """ Play random moves until the game is over, or until max_moves moves were made, and return whether it is.
+        """
+        played = 0
+        while self.winner is None:
+            moves = [col for col in range(self.cols) if self.board[col][0] == NONE]
+            if not moves:
+                return True
+            if played == max_moves:
+                return False
+            self.DoMove(random.choice(moves))
+            played += 1
+        return True
+
+
     def GetMoves(self):
         """ Get all possible moves from this state.
         """
@@ -88,6 +165,22 @@ class ConnectFourState(GameState):
         
         return moves
        
+    def Hash(self):
+        """ The Zobrist hash of the discs on the board and the player to move.
+        """
+        return self.hash ^ ZobristKey("to_move", self.playerToMove)
+
+    def CanonicalHash(self):
+        """ The Hash() of this position or of its mirror image, whichever is smaller, and whether it was the mirror's.
+        """
+        to_move = ZobristKey("to_move", self.playerToMove)
+        if self.mirror_hash < self.hash:
+            return self.mirror_hash ^ to_move, True
+        return self.hash ^ to_move, False
+
+    def MirrorPolicy(self, policy):
+        return mirror_policy(policy)
+
     def GetResult(self, player):
         """ Get the game result from the viewpoint of player. 
         """
@@ -108,49 +201,26 @@ class ConnectFourState(GameState):
         return str(self)
     
     def to_inputs(self, player_number):
-        inputs = deepcopy(self.board)
-        final_inputs = []
         my_color = RED if player_number == 0 else YELLOW
         opponent_color = YELLOW if player_number == 0 else RED
-        for y in range(self.rows):
-            for x in range(self.cols):                 
-                inputs[x][y] = 1 if inputs[x][y] == my_color else (-1 if inputs[x][y] == opponent_color else 0)
-                final_inputs.append(inputs[x][y])
-                continue
-                final_inputs.extend([
-                        1 if inputs[x][y] == 1 else 0, 
-                        1 if inputs[x][y] == -1 else 0, 
-                        1 if inputs[x][y] == 0 else 0
-                ])
-
-        return final_inputs
+        # Row by row from the top, 1 for the player's discs and -1 for the opponent's
+        return [1 if c[y] == my_color else (-1 if c[y] == opponent_color else 0) for y in range(self.rows) for c in self.board]
     
     def predict(self, model, player, use_boards=False):
+        values, priors = ConnectFourState.predict_batch(model, [self], [player], use_boards=use_boards)
+        return values[0], priors[0]
+    
+    @staticmethod
+    def predict_batch(model, states, players, use_boards=False):
+        """ Evaluate many states with a single model call. The model outputs the value of each state
+            for its player followed by one prior per column; return (values, priors) arrays.
+        """
+        boards = np.array([state.to_inputs(player) for state, player in zip(states, players)])
         if use_boards:
-            boards = []
-            for data in np.array([self.to_inputs(player)]):
-                #print("=========Loading Board========")
-                board = []
-                prev = 0
-                row_sum = 0
-                for i in range(6):
-                    row = data[prev:(i+1)*7]
-                    board.append(row)
-                    prev = (i+1)*7
-                    #print(row)
-                    row_sum += len(row)
-                boards.append(board)
-
-            boards = np.asarray(boards)    
+            # One 6x7x1 image per state, rows of 7 as laid out by to_inputs
             boards = boards.reshape(len(boards), 6, 7, 1)
-        else:
-            boards = np.array([self.to_inputs(player)])
         prediction = model.predict(boards, verbose=0)
-        #prediction = prediction[0]
-        #print(prediction)
-        #print(prediction[0])
-        #print(prediction[1:])
-        return prediction[0], prediction[1:]
+        return prediction[:, 0], prediction[:, 1:]
     
     def insert (self, column, color):
         """Insert the color in the given column."""
@@ -162,21 +232,34 @@ class ConnectFourState(GameState):
         while c[i] != NONE:
             i -= 1
         c[i] = color
+        self.hash ^= ZobristKey("disc", column, self.rows + i, color)
+        self.mirror_hash ^= ZobristKey("disc", self.cols - 1 - column, self.rows + i, color)
+        # Only the lines through the new disc can have been completed by it
+        if self.winner is None and self.isWinningDisc(column):
+            self.winner = color
 
     def getWinner (self):
         """Get the winner on the current board."""
-        lines = (
-            self.board, # columns
-            zip(*self.board), # rows
-            diagonalsPos(self.board, self.cols, self.rows), # positive diagonals
-            diagonalsNeg(self.board, self.cols, self.rows) # negative diagonals
-        )
+        return self.winner
+
+    def isWinningDisc (self, column):
+        """Check whether the top disc of the given column completes a line."""
+        c = self.board[column]
+        row = 0
+        while c[row] == NONE:
+            row += 1
+        color = c[row]
+        for dx, dy in ((1, 0), (0, 1), (1, 1), (1, -1)):
+            count = 1
+            for sign in (1, -1):
+                x, y = column + sign * dx, row + sign * dy
+                while 0 <= x < self.cols and 0 <= y < self.rows and self.board[x][y] == color:
+                    count += 1
+                    x, y = x + sign * dx, y + sign * dy
+            if count >= self.win:
+                return True
+        return False
 
-        for line in chain(*lines):
-            for color, group in groupby(line):
-                if color != NONE and len(list(group)) >= self.win:
-                    return color
-    
     def getBoard(self):
         result = '  '.join(map(str, range(self.cols))) + "\n"
         for y in range(self.rows):
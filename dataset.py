@@ -0,0 +1,478 @@
+import argparse
+import heapq
+import json
+import os
+import queue
+import shutil
+import threading
+import numpy as np
+
+INDEX_FILE = "index.json"
+
+def state_features(state, player):
+    """ The features of state from the viewpoint of player as a float32 array, using encode_inputs()
+        where the state has it (VillainousState) and to_inputs() otherwise.
+    """
+    if hasattr(state, "encode_inputs"):
+        return state.encode_inputs(player)
+    return np.asarray(state.to_inputs(player), dtype=np.float32)
+
+class SampleWriter:
+    """ Streams training samples, (features, value, policy) rows, into a directory of .npy shards.
+        Samples are encoded as soon as they are added and handed to a background thread, which fills one
+        shard of shard_size rows at a time and writes it out as shard-NNNNN.x.npy (features), .y.npy (values)
+        and, when policies are recorded, .p.npy. index.json lists the shards written so far, so a reader
+        never sees a partly written shard. Memory is bounded by the shard being filled and max_pending
+        samples waiting for the writer thread; add() blocks when the thread falls behind.
+
+        A directory that already has an index is appended to. Every sample must have the same number of
+        features (and of policy entries). Use the writer as a context manager, or call close() when done.
+
+            with SampleWriter("data/hook") as recorder:
+                ISMCTS(state, 500, recorder=recorder)
+    """
+    _FLUSH = object()
+
+    def __init__(self, directory, shard_size=4096, max_pending=4096):
+        self.directory = directory
+        self.shard_size = shard_size
+        os.makedirs(directory, exist_ok=True)
+        self.index = read_index(directory) or {"features": None, "policy": None, "shards": []}
+        self.features = self.index["features"]
+        self.policy = self.index["policy"]
+        self.samples = 0
+        self.error = None
+        self.closed = False
+        self.pending = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self._Write, daemon=True)
+        self.thread.start()
+
+    def add(self, features, value, policy=None):
+        """ Queue one sample for writing. features and policy are converted to float32 arrays right away.
+        """
+        self._CheckError()
+        if self.closed:
+            raise ValueError("SampleWriter is closed")
+        features = np.asarray(features, dtype=np.float32).reshape(-1)
+        if self.features is None:
+            self.features = len(features)
+            self.policy = None if policy is None else len(policy)
+        if len(features) != self.features:
+            raise ValueError(f"Expected {self.features} features, got {len(features)}")
+        if (policy is None) != (self.policy is None):
+            raise ValueError("Either every sample or none must have a policy")
+        if policy is not None:
+            policy = np.asarray(policy, dtype=np.float32).reshape(-1)
+            if len(policy) != self.policy:
+                raise ValueError(f"Expected {self.policy} policy entries, got {len(policy)}")
+        self.pending.put((features, value, policy))
+        self.samples += 1
+
+    def add_state(self, state, player, value, policy=None):
+        """ Queue state, encoded from the viewpoint of player (see state_features), with its value and policy.
+        """
+        self.add(state_features(state, player), value, policy)
+
+    def flush(self):
+        """ Write out the samples added so far, even if that leaves a short shard, and wait until they are on disk.
+        """
+        self._CheckError()
+        self.pending.put(self._FLUSH)
+        self.pending.join()
+        self._CheckError()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.thread.join()
+        self._CheckError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __deepcopy__(self, memo):
+        # Agents holding a recorder are copied per game (see simulate.py) and keep writing to the same shards
+        return self
+
+    def _CheckError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _Write(self):
+        x = y = p = None
+        rows = 0
+        while True:
+            sample = self.pending.get()
+            try:
+                if sample is None or sample is self._FLUSH:
+                    if rows > 0:
+                        self._WriteShard(x[:rows], y[:rows], None if p is None else p[:rows])
+                        rows = 0
+                    if sample is None:
+                        return
+                    continue
+                features, value, policy = sample
+                if x is None:
+                    # The shard being filled, allocated once for the life of the writer
+                    x = np.zeros((self.shard_size, len(features)), dtype=np.float32)
+                    y = np.zeros(self.shard_size, dtype=np.float32)
+                    p = None if policy is None else np.zeros((self.shard_size, len(policy)), dtype=np.float32)
+                x[rows] = features
+                y[rows] = value
+                if p is not None:
+                    p[rows] = policy
+                rows += 1
+                if rows == self.shard_size:
+                    self._WriteShard(x, y, p)
+                    rows = 0
+            except Exception as e:
+                self.error = e
+            finally:
+                self.pending.task_done()
+
+    def _WriteShard(self, x, y, p):
+        name = f"shard-{len(self.index['shards']):05d}"
+        np.save(os.path.join(self.directory, f"{name}.x.npy"), x)
+        np.save(os.path.join(self.directory, f"{name}.y.npy"), y)
+        if p is not None:
+            np.save(os.path.join(self.directory, f"{name}.p.npy"), p)
+        self.index["features"] = x.shape[1]
+        self.index["policy"] = None if p is None else p.shape[1]
+        self.index["shards"].append({"name": name, "rows": len(x)})
+        write_index(self.directory, self.index)
+
+def read_index(directory):
+    """ The index of a shard directory, or None if it has none yet.
+    """
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_index(directory, index):
+    # Replace the index in one step, so readers see either the old or the new list of shards
+    path = os.path.join(directory, INDEX_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(path + ".tmp", path)
+
+class ShardedDataset:
+    """ Reads a directory written by SampleWriter without loading it: each shard is memory-mapped when it is
+        first needed, and batches() only ever holds a few shards in memory at once.
+    """
+
+    def __init__(self, directory):
+        index = read_index(directory)
+        if index is None:
+            raise FileNotFoundError(f"No {INDEX_FILE} in {directory}")
+        self.directory = directory
+        self.features = index["features"]
+        self.policy = index["policy"]
+        self.shards = [(shard["name"], shard["rows"]) for shard in index["shards"]]
+        self.arrays = {}
+
+    def __len__(self):
+        return sum(rows for name, rows in self.shards)
+
+    def steps(self, batch_size):
+        """ The number of batches in an epoch, e.g. for Keras' steps_per_epoch. """
+        return -(-len(self) // batch_size)
+
+    def shard(self, i):
+        """ The memory-mapped (features, values, policies) arrays of shard i; policies is None if none were recorded.
+        """
+        arrays = self.arrays.get(i)
+        if arrays is None:
+            name = self.shards[i][0]
+            path = os.path.join(self.directory, name)
+            arrays = self.arrays[i] = (np.load(f"{path}.x.npy", mmap_mode="r"), np.load(f"{path}.y.npy", mmap_mode="r"),
+                                       None if self.policy is None else np.load(f"{path}.p.npy", mmap_mode="r"))
+        return arrays
+
+    def targets(self, i):
+        """ The training targets of shard i: the values, followed by the policy on each row if one was recorded.
+        """
+        x, y, p = self.shard(i)
+        if p is None:
+            return y
+        return np.concatenate([y[:, None], p], axis=1)
+
+    def batches(self, batch_size, shuffle=True, epochs=1, seed=None, board_shape=None, shards_per_block=8):
+        """ Yield (features, targets) batches of batch_size rows, epochs times over (forever if epochs is None).
+            With shuffle, the shards are visited in a random order, shards_per_block of them are read into memory
+            at a time and their rows shuffled together. board_shape reshapes each row of features, e.g. (6, 7, 1)
+            for the Connect Four conv model. Only the last batch of an epoch can be short.
+        """
+        rng = np.random.default_rng(seed)
+        epoch = 0
+        while epochs is None or epoch < epochs:
+            epoch += 1
+            order = rng.permutation(len(self.shards)) if shuffle else np.arange(len(self.shards))
+            leftover_x = np.zeros((0, self.features), dtype=np.float32)
+            leftover_y = None
+            for start in range(0, len(order), shards_per_block):
+                block = order[start:start + shards_per_block]
+                x = np.concatenate([leftover_x] + [self.shard(i)[0] for i in block])
+                y = np.concatenate(([] if leftover_y is None else [leftover_y]) + [self.targets(i) for i in block])
+                if shuffle:
+                    permutation = rng.permutation(len(x))
+                    x = x[permutation]
+                    y = y[permutation]
+                full = len(x) - len(x) % batch_size
+                for i in range(0, full, batch_size):
+                    yield self._Batch(x[i:i + batch_size], board_shape), y[i:i + batch_size]
+                leftover_x, leftover_y = x[full:], y[full:]
+            if len(leftover_x) > 0:
+                yield self._Batch(leftover_x, board_shape), leftover_y
+
+    def _Batch(self, x, board_shape):
+        return x if board_shape is None else x.reshape((len(x),) + tuple(board_shape))
+
+    def arrays_in_memory(self, board_shape=None):
+        """ The whole dataset as (features, targets) arrays, for small datasets and code that needs arrays.
+        """
+        x = np.concatenate([self.shard(i)[0] for i in range(len(self.shards))])
+        y = np.concatenate([self.targets(i) for i in range(len(self.shards))])
+        return self._Batch(x, board_shape), y
+
+class ReplayBuffer:
+    """ A fixed-capacity store of training samples that keeps one entry per distinct position. A sample whose
+        features are already stored is merged into that entry, whose value and policy targets are the means over
+        every time the position was added. Once capacity positions are stored, a new one evicts the oldest entry
+        ("fifo") or the one of lowest priority ("priority", the oldest of those on a tie). Training batches are
+        drawn uniformly, or in proportion to priority ** alpha.
+
+        A buffer can stand in for a SampleWriter as the recorder of a search or of SelfPlayGame, and for a
+        ShardedDataset as the data of get_model(train=True, data=...). save() writes it out as a shard directory.
+    """
+
+    def __init__(self, capacity, eviction="fifo", alpha=0.6):
+        if eviction not in ("fifo", "priority"):
+            raise ValueError(f"Unknown eviction {eviction!r}, expected 'fifo' or 'priority'")
+        self.capacity = capacity
+        self.eviction = eviction
+        self.alpha = alpha
+        self.features = None
+        self.policy = None
+        # Allocated on the first add, once the number of features (and policy entries) is known
+        self.x = None
+        self.value_sums = None
+        self.policy_sums = None
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.priorities = np.zeros(capacity, dtype=np.float64)
+        self.slots = {} # features.tobytes() -> slot
+        self.keys = [None] * capacity
+        self.size = 0
+        self.next = 0 # with fifo eviction, the slot to overwrite next
+        self.heap = [] # with priority eviction, (priority, version, slot), skipping entries whose version is stale
+        self.versions = np.zeros(capacity, dtype=np.int64)
+        self.version = 0
+        self.added = 0
+        self.merged = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, features, value, policy=None, priority=1.0):
+        """ Store one sample, or merge it into the entry for the same features, and return its slot.
+            A merged entry keeps the higher of its priority and priority.
+        """
+        features = np.asarray(features, dtype=np.float32).reshape(-1)
+        if self.x is None:
+            self.features = len(features)
+            self.policy = None if policy is None else len(policy)
+            self.x = np.zeros((self.capacity, self.features), dtype=np.float32)
+            self.value_sums = np.zeros(self.capacity, dtype=np.float64)
+            self.policy_sums = None if policy is None else np.zeros((self.capacity, self.policy), dtype=np.float64)
+        if len(features) != self.features:
+            raise ValueError(f"Expected {self.features} features, got {len(features)}")
+        if (policy is None) != (self.policy is None):
+            raise ValueError("Either every sample or none must have a policy")
+        if policy is not None:
+            policy = np.asarray(policy, dtype=np.float32).reshape(-1)
+            if len(policy) != self.policy:
+                raise ValueError(f"Expected {self.policy} policy entries, got {len(policy)}")
+        self.added += 1
+        key = features.tobytes()
+        slot = self.slots.get(key)
+        if slot is not None:
+            self.merged += 1
+            if priority > self.priorities[slot]:
+                self._SetPriority(slot, priority)
+        else:
+            slot = self._FreeSlot()
+            self.slots[key] = slot
+            self.keys[slot] = key
+            self.x[slot] = features
+            self.counts[slot] = 0
+            self.value_sums[slot] = 0
+            if policy is not None:
+                self.policy_sums[slot] = 0
+            self._SetPriority(slot, priority)
+        self.counts[slot] += 1
+        self.value_sums[slot] += value
+        if policy is not None:
+            self.policy_sums[slot] += policy
+        return slot
+
+    def add_state(self, state, player, value, policy=None):
+        """ Store state, encoded from the viewpoint of player (see state_features), with its value and policy.
+        """
+        return self.add(state_features(state, player), value, policy)
+
+    def __deepcopy__(self, memo):
+        # Like a SampleWriter, shared by the copies of the agents recording into it
+        return self
+
+    def extend(self, dataset):
+        """ Add every sample of a ShardedDataset, e.g. to start from the data of an earlier run.
+        """
+        for i in range(len(dataset.shards)):
+            x, y, p = dataset.shard(i)
+            for row in range(len(x)):
+                self.add(x[row], y[row], None if p is None else p[row])
+
+    def _FreeSlot(self):
+        if self.size < self.capacity:
+            self.size += 1
+            return self.size - 1
+        if self.eviction == "fifo":
+            slot = self.next
+            self.next = (self.next + 1) % self.capacity
+        else:
+            while True:
+                priority, version, slot = heapq.heappop(self.heap)
+                if self.versions[slot] == version:
+                    break
+        del self.slots[self.keys[slot]]
+        self.evicted += 1
+        return slot
+
+    def _SetPriority(self, slot, priority):
+        self.priorities[slot] = priority
+        if self.eviction == "priority":
+            self.version += 1
+            self.versions[slot] = self.version
+            heapq.heappush(self.heap, (priority, self.version, slot))
+            if len(self.heap) > 4 * self.capacity:
+                # Drop the stale entries left by priority updates
+                self.heap = [entry for entry in self.heap if self.versions[entry[2]] == entry[1]]
+                heapq.heapify(self.heap)
+
+    def update_priorities(self, slots, priorities):
+        """ Set the priority of each of slots, such as the training loss of the samples drawn from them.
+        """
+        for slot, priority in zip(slots, priorities):
+            self._SetPriority(int(slot), float(priority))
+
+    def targets(self, slots):
+        """ The training targets of slots: the mean value, followed by the mean policy if policies are stored.
+        """
+        values = (self.value_sums[slots] / self.counts[slots]).astype(np.float32)
+        if self.policy is None:
+            return values
+        policies = (self.policy_sums[slots] / self.counts[slots][:, None]).astype(np.float32)
+        return np.concatenate([values[:, None], policies], axis=1)
+
+    def sample(self, batch_size, prioritized=False, rng=None):
+        """ Draw batch_size samples with replacement, uniformly or in proportion to priority ** alpha, and return
+            (features, targets, slots); slots can be given back to update_priorities.
+        """
+        rng = np.random if rng is None else rng
+        if prioritized:
+            weights = self.priorities[:self.size] ** self.alpha
+            slots = rng.choice(self.size, batch_size, p=weights / weights.sum())
+        else:
+            slots = rng.choice(self.size, batch_size)
+        return self.x[slots], self.targets(slots), slots
+
+    def steps(self, batch_size):
+        """ The number of batches in an epoch, e.g. for Keras' steps_per_epoch. """
+        return -(-self.size // batch_size)
+
+    def batches(self, batch_size, shuffle=True, epochs=1, seed=None, board_shape=None, prioritized=False):
+        """ Yield (features, targets) batches like ShardedDataset.batches(). An epoch is steps(batch_size) batches:
+            each stored sample once, or with prioritized, batches drawn as by sample().
+        """
+        rng = np.random.default_rng(seed)
+        epoch = 0
+        while epochs is None or epoch < epochs:
+            epoch += 1
+            if prioritized:
+                for step in range(self.steps(batch_size)):
+                    x, y, slots = self.sample(batch_size, prioritized=True, rng=rng)
+                    yield self._Batch(x, board_shape), y
+                continue
+            order = rng.permutation(self.size) if shuffle else np.arange(self.size)
+            for i in range(0, self.size, batch_size):
+                slots = order[i:i + batch_size]
+                yield self._Batch(self.x[slots], board_shape), self.targets(slots)
+
+    def _Batch(self, x, board_shape):
+        return x if board_shape is None else x.reshape((len(x),) + tuple(board_shape))
+
+    def save(self, directory, shard_size=4096):
+        """ Write the stored samples, with their merged targets, to directory as a shard directory,
+            replacing whatever was there.
+        """
+        temporary = directory + ".tmp"
+        shutil.rmtree(temporary, ignore_errors=True)
+        with SampleWriter(temporary, shard_size=shard_size) as writer:
+            for start in range(0, self.size, shard_size):
+                slots = np.arange(start, min(start + shard_size, self.size))
+                for slot, target in zip(slots, self.targets(slots)):
+                    if self.policy is None:
+                        writer.add(self.x[slot], target)
+                    else:
+                        writer.add(self.x[slot], target[0], target[1:])
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temporary, directory)
+
+def convert_csv(csv_path, directory, features, shard_size=4096):
+    """ Convert a CSV of samples, as game.txt was written (features, then the value, then any policy entries on
+        each line), into a shard directory. The CSV is read a line at a time, so it never has to fit in memory.
+    """
+    with open(csv_path) as f, SampleWriter(directory, shard_size=shard_size) as writer:
+        for line in f:
+            if not line.strip():
+                continue
+            row = np.fromstring(line, dtype=np.float32, sep=",")
+            writer.add(row[:features], row[features], row[features + 1:] if len(row) > features + 1 else None)
+    return ShardedDataset(directory)
+
+def open_dataset(path, features):
+    """ Open the training data at path: a shard directory, or a CSV such as game.txt, which is converted
+        once into the directory path + ".shards" (and again whenever the CSV is newer than it).
+        A dataset that is already open (a ShardedDataset or ReplayBuffer) is returned as it is.
+    """
+    if hasattr(path, "batches"):
+        return path
+    if os.path.isdir(path):
+        return ShardedDataset(path)
+    directory = path + ".shards"
+    index = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(index) or os.path.getmtime(path) > os.path.getmtime(index):
+        shutil.rmtree(directory, ignore_errors=True)
+        return convert_csv(path, directory, features)
+    return ShardedDataset(directory)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a CSV of training samples (such as game.txt) into .npy shards.")
+    parser.add_argument("csv")
+    parser.add_argument("directory")
+    parser.add_argument("--features", type=int, required=True, help="columns before the value, e.g. 42 for Connect Four, 460 for Villainous")
+    parser.add_argument("--shard-size", type=int, default=4096)
+    args = parser.parse_args()
+    dataset = convert_csv(args.csv, args.directory, args.features, shard_size=args.shard_size)
+    print(f"{len(dataset)} samples of {dataset.features} features in {len(dataset.shards)} shards")
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,16 @@ from enum import Enum
 from moves import *
 import random
 import collections
-from monte import GameState, PlayGame, ISMCTS
-from itertools import chain, combinations
+from monte import GameState, PlayGame, ISMCTS, ZobristKey, MixHash, HASH_MASK, TranspositionTable
+from itertools import accumulate, chain, combinations
+from array import array
 import hook
 import operator
 import numpy as np
+import importlib
+import json
+import os
+import sys
 
 VERBOSE_LOG = False
 
@@ -19,18 +24,64 @@ def powerset(iterable):
     # note we return an iterator rather than a list
     return chain.from_iterable(combinations(xs,n) for n in range(len(xs)+1))
 
+def vanquish_ally_sets(allies, strengths, needed, minimal=False):
+    """ Yield the subsets of allies (as tuples, in powerset order) whose strengths add up to at least needed.
+        A partial set is dropped as soon as the strongest allies left to add could not make up the difference.
+        With minimal, only sets that stop being enough when any one of their allies is taken out are yielded.
+    """
+    n = len(allies)
+    # strongest[i][k] and weakest[i][k] are the total strength of the k strongest and weakest allies in allies[i:]
+    strongest = []
+    weakest = []
+    for i in range(n + 1):
+        remaining = sorted(strengths[i:])
+        strongest.append(list(accumulate(reversed(remaining), initial=0)))
+        weakest.append(list(accumulate(remaining, initial=0)))
+
+    def extend(start, size, chosen, total):
+        if size == 0:
+            if total >= needed and (not minimal or not chosen or total - min(strengths[i] for i in chosen) < needed):
+                yield tuple(allies[i] for i in chosen)
+            return
+        if minimal and total >= needed:
+            return # any ally added now could be taken out again
+        if not minimal and total + weakest[start][size] >= needed:
+            # Every way of finishing the set is strong enough
+            prefix = tuple(allies[i] for i in chosen)
+            for rest in combinations(allies[start:], size):
+                yield prefix + rest
+            return
+        for i in range(start, n - size + 1):
+            if total + strongest[i][size] < needed:
+                return # the allies after i are weaker still
+            if total + strengths[i] + strongest[i + 1][size - 1] < needed:
+                continue
+            chosen.append(i)
+            yield from extend(i + 1, size - 1, chosen, total + strengths[i])
+            chosen.pop()
+
+    for size in range(n + 1):
+        yield from extend(0, size, [], 0)
+
 class VillainousState(GameState):
     
     MOVE_ZONE_PHASE = 0
     ACTION_PHASE = 1
     
-    def __init__(self, players, game_init=True):
+    VANQUISH_POLICIES = ("all", "minimal")
+    
+    def __init__(self, players, game_init=True, vanquish_policy="all"):
         """ Initialise the game state. n is the number of players (from 2 to 7).
+            vanquish_policy chooses the ally sets offered for each vanquish: "all" the sets strong enough
+            to defeat the hero, or "minimal" only those in which every ally is needed.
         """
+        if vanquish_policy not in self.VANQUISH_POLICIES:
+            raise ValueError(f"Unknown vanquish policy: {vanquish_policy}")
+        self.vanquish_policy = vanquish_policy
         self.numberOfPlayers = len(players)
         self.playerToMove = 0            
         self.players = players
-        self.actions_used = []
+        self.actions_used = 0 # bitmask of the Action.bit of each action used this turn
         self.interrupt_moves = []
         self.phase = self.ACTION_PHASE if game_init else self.MOVE_ZONE_PHASE
         self.turn = 1
@@ -47,45 +98,64 @@ class VillainousState(GameState):
                     extra_power = 3
                 player.power += extra_power
                 
-                for action in [a for a in player.board_position.available_actions() if type(a) is PowerAction]:
+                for action in player.board_position.power_actions():
                     player.power += action.power
+        self.UpdateResults()
     
     def Clone(self):
-        """ Create a deep clone of this game state.
+        """ Create a clone of this game state that can be changed independently of it.
+            Only the containers a move can change are copied: card definitions, zone actions and
+            the Villains are shared, and the only cards copied are those on the board (see PlayerState.Clone).
         """
-        st = VillainousState(deepcopy(self.players), game_init=False)
+        st = VillainousState([player.Clone() for player in self.players], game_init=False, vanquish_policy=self.vanquish_policy)
         st.card_encoding = self.card_encoding
         st.playerToMove = self.playerToMove
-        st.actions_used = deepcopy(self.actions_used)
-        st.interrupt_moves = deepcopy(self.interrupt_moves)
+        st.actions_used = self.actions_used
+        st.interrupt_moves = copy(self.interrupt_moves)
         st.phase = self.phase
         st.turn = self.turn
 
         return st
     
+    def __getstate__(self):
+        # The bits of actions_used are assigned per process (see action_bit), so it is pickled as the used actions' keys
+        state = self.__dict__.copy()
+        state["actions_used"] = list(used_action_keys(self.actions_used))
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        actions_used = 0
+        for key in self.actions_used:
+            actions_used |= action_bit(key)
+        self.actions_used = actions_used
+
     def CloneAndRandomize(self, observer):
         """ Create a deep clone of this game state, randomizing any information not visible to the specified observer player.
         """
-        st = self.Clone()             
+        st = self.Clone()
+        st.Randomize(observer)
+        return st
+
+    def Randomize(self, observer):
+        """ Randomize, in place, any information not visible to the specified observer player.
+        """
         #print(f"Randomizing from {observer}'s perspective")
         # The observer can see their own hand and their discard pile, so the only unknown is how their deck is shuffled  
-        random.shuffle(st.players[observer].deck)
-        random.shuffle(st.players[observer].fate)
+        self.players[observer].deck.shuffle()
+        self.players[observer].fate.shuffle()
         
-        for player in st.players:
-            if player != st.players[observer]:
+        for player in self.players:
+            if player != self.players[observer]:
                 #print(f"Shuffling data for {player.identifier}")
                 unseenCards = player.deck + player.hand#deepcopy(player.deck) + deepcopy(player.hand)
-                random.shuffle(unseenCards)
+                unseenCards.shuffle()
                 numCards = len(player.hand)
                 # The first numCards unseen cards are the new hand
                 player.hand = unseenCards[:numCards] #deepcopy(unseenCards[:numCards])
                 # The rest are the new deck
                 player.deck = unseenCards[numCards:] #deepcopy(unseenCards[numCards:])   
-                random.shuffle(player.fate)
-
-        
-        return st
+                player.fate.shuffle()
     
     def GetNextPlayer(self, p):
         """ Return the player to the left of the specified player """
@@ -103,26 +173,51 @@ class VillainousState(GameState):
         player = self.players[self.playerToMove]
         move.perform(self, player)
         if move.parent_action is not None:
-            self.actions_used.append(move.parent_action)
+            self.actions_used |= move.parent_action.bit
         if move in self.interrupt_moves:
             self.interrupt_moves.clear()
+        if move.can_change_result:
+            self.UpdateResults()
         
         did_move_phase = False
         if self.phase == self.MOVE_ZONE_PHASE:  
             if type(move) is MoveZoneMove:
                 player.can_stay_on_zone = False
-                for action in [a for a in player.board_position.available_actions() if type(a) is PowerAction]:
+                for action in player.board_position.power_actions():
                     player.power += action.power
-                    self.actions_used.append(action)
+                    self.actions_used |= action.bit
+                self.UpdateResults()
                 self.phase = self.ACTION_PHASE     
-                if self.GetMoves() == []:
+                if not self.GetMoves():
                     self.EndPlayerTurn()
         elif self.phase == self.ACTION_PHASE:
-            if self.GetMoves() == [] or type(move) is EndTurnMove:
+            if type(move) is EndTurnMove or not self.GetMoves():
                 # Out of moves, this player's turn is over
                 self.EndPlayerTurn()
         
         return self
+
+    def DoUndoableMove(self, move):
+        """ Carry out the given move like DoMove, and return a token that UndoMove can use to take it back.
+            The token holds shallow copies of the piles and counters of the moving player, and of the zones
+            and other players only when the move can change them (see Move.changes_board).
+        """
+        if move.changes_others:
+            players = self.players
+        else:
+            players = (self.players[self.playerToMove],)
+        token = (self.playerToMove, self.phase, self.turn, self.results, self.terminal, self.actions_used,
+                 copy(self.interrupt_moves), [(player, player.Snapshot(move.changes_board)) for player in players])
+        self.DoMove(move)
+        return token
+
+    def UndoMove(self, token):
+        """ Restore the state from before the DoUndoableMove call that returned token.
+        """
+        (self.playerToMove, self.phase, self.turn, self.results, self.terminal, self.actions_used,
+         self.interrupt_moves, players) = token
+        for player, snapshot in players:
+            player.Restore(snapshot)
     
     def EndPlayerTurn(self):
         player = self.players[self.playerToMove]
@@ -134,18 +229,18 @@ class VillainousState(GameState):
             self.phase = self.ACTION_PHASE
         else:
             self.phase = self.MOVE_ZONE_PHASE
-        self.actions_used = []
+        self.actions_used = 0
         self.turn += 1
     
     
     def GetMoves(self):
-        """ Get all possible moves from this state.
+        """ Get all possible moves from this state, as a MoveList: discards and other choices of
+            a subset of cards are only turned into moves when they are indexed or iterated.
         """
-        moves = []
+        moves = MoveList()
         # Return empty moves if the game is over
-        for player in self.players:
-            if player.has_won(self):
-                return moves
+        if self.terminal:
+            return moves
         
         if len(self.interrupt_moves) > 0:
             return self.interrupt_moves
@@ -156,21 +251,24 @@ class VillainousState(GameState):
                 moves.append(MoveZoneMove(zone))
           
         elif self.phase == self.ACTION_PHASE:
-            actions_remaining = [action for action in player.board_position.available_actions() if action not in self.actions_used]
-            #for action in player.board_position.available_actions():
-                #if action not in self.actions_used:
-                    #actions_remaining.append(action)
+            actions_used = self.actions_used
             calculated_playable_cards = False
-            for action in actions_remaining:            
+            for action in player.board_position.available_actions():
+                if actions_used & action.bit:
+                    continue
                 if type(action) is PlayCardAction and not calculated_playable_cards: #TODO: maybe not a needed optimization
                     calculated_playable_cards = True
                     for card in player.hand:
                         if card.cost <= player.power:
                             if card.targeted:
                                 targets = card.target_set(player, self)
-                                for target in targets:
-                                    if card.card_type == CardType.EFFECT:
-                                        moves.append(PlayCardMove(card, action, target=target))
+                                if card.card_type == CardType.EFFECT:
+                                    if isinstance(targets, Subsets):
+                                        moves.extend_lazy(targets, lambda target, card=card, action=action: PlayCardMove(card, action, target=target),
+                                                          lambda move, card=card: move.target_subset(card) if type(move) is PlayCardMove else None)
+                                    else:
+                                        for target in targets:
+                                            moves.append(PlayCardMove(card, action, target=target))
                             else:                               
                                 if card.card_type == CardType.EFFECT:
                                     moves.append(PlayCardMove(card, action))
@@ -185,10 +283,9 @@ class VillainousState(GameState):
                                             moves.append(PlayCardMove(card, action, zone=zone))
                                         
                 elif type(action) is DiscardAction:   
-                    # Get every possible combination of cards to discard
-                    for cards in powerset(player.hand):
-                        if len(cards) > 0:
-                            moves.append(DiscardCardsMove(cards, action))
+                    # Every possible combination of cards to discard
+                    moves.extend_lazy(Subsets(player.hand, min_size=1), lambda cards, action=action: DiscardCardsMove(cards, action),
+                                      lambda move: move.cards if type(move) is DiscardCardsMove else None)
                 elif type(action) is MoveAllyAction or type(action) is MoveHeroAction:
                     for zone in player.board:
                         if zone.locked:
@@ -204,21 +301,20 @@ class VillainousState(GameState):
                     for zone in player.board:
                         if zone.locked:
                             continue
+                        valid_allies = zone.allies
+                        
+                        # TODO: need a way of tracking where these allies come from in the Move so that we can remove them properly
+                        #if zone.number > 0 and not player.board[zone.number - 1].locked:
+                        #    valid_allies.extend([ally for ally in player.board[zone.number - 1].allies if ally.card_ally.adjacent_vanquish])
+                        #if zone.number < 3 and not player.board[zone.number + 1].locked:
+                        #    valid_allies.extend([ally for ally in player.board[zone.number + 1].allies if ally.card_ally.adjacent_vanquish])
+                        
+                        # Ally strengths don't depend on the hero, so they are summed once per zone
+                        strengths = [ally.get_total_strength(zone) for ally in valid_allies]
                         for hero in zone.heroes:
-                            valid_allies = zone.allies
-                            
-                            # TODO: need a way of tracking where these allies come from in the Move so that we can remove them properly
-                            #if zone.number > 0 and not player.board[zone.number - 1].locked:
-                            #    valid_allies.extend([ally for ally in player.board[zone.number - 1].allies if ally.card_ally.adjacent_vanquish])
-                            #if zone.number < 3 and not player.board[zone.number + 1].locked:
-                            #    valid_allies.extend([ally for ally in player.board[zone.number + 1].allies if ally.card_ally.adjacent_vanquish])
-                            
-                            for ally_set in powerset(valid_allies):
-                                total_strength = 0
-                                for ally in ally_set:
-                                    total_strength += ally.get_total_strength(zone)
-                                if total_strength >= hero.get_total_strength(zone):
-                                    moves.append(VanquishMove(ally_set, hero, zone, action))
+                            for ally_set in vanquish_ally_sets(valid_allies, strengths, hero.get_total_strength(zone),
+                                                               minimal=self.vanquish_policy == "minimal"):
+                                moves.append(VanquishMove(ally_set, hero, zone, action))
                 
                 elif type(action) is FateAction:
                     for i in range(0, self.numberOfPlayers):                   
@@ -239,7 +335,35 @@ class VillainousState(GameState):
     def GetResult(self, player):
         """ Get the game result from the viewpoint of player. 
         """
-        return 1 if self.players[player].has_won(self) else 0
+        return self.results[player]
+
+    def Hash(self):
+        """ A 64-bit Zobrist hash of the position: the phase, whose turn it is, the actions used this turn and
+            everything about each player (see PlayerState.Hash). The piles keep their part of it up to date as
+            cards move, so hashing does not depend on how many cards they hold. The turn number is left out,
+            so the same position reached by different move orders hashes the same.
+        """
+        h = ZobristKey("phase", self.phase) ^ ZobristKey("to_move", self.playerToMove)
+        used = 0
+        for key in used_action_keys(self.actions_used):
+            used += ZobristKey("used", key)
+        interrupts = 0
+        for move in self.interrupt_moves:
+            interrupts += ZobristKey("interrupt", move.key())
+        h ^= (used & HASH_MASK) ^ (interrupts & HASH_MASK)
+        for i, player in enumerate(self.players):
+            h ^= player.Hash(i)
+        return h
+
+    def IsTerminal(self):
+        return self.terminal
+
+    def UpdateResults(self):
+        """ Work out who has won. DoMove calls this after any move that can change it (see Move.can_change_result),
+            so GetResult() and IsTerminal() only read the stored results.
+        """
+        self.results = tuple(1 if player.has_won(self) else 0 for player in self.players)
+        self.terminal = 1 in self.results
     
     def __str__(self):
         result = f"Turn {self.turn} | {self.players[self.playerToMove].identifier}'s Turn " + ("\n" if self.numberOfPlayers > 1 else "")
@@ -272,55 +396,120 @@ class VillainousState(GameState):
         return str(self)
 
     def to_inputs(self, player_number):
-        num_cards = len(self.card_encoding)# - 1
-        #num_hand_cards = self.card_encoding["non_fate"]
-        #print(f"Num cards: {num_cards}, non-fate: {num_hand_cards}")
-        player = self.players[player_number]
-        
-        inputs = [1 if player_number == self.playerToMove else 0, player.power]
+        """ The features of this state from the viewpoint of player_number, as a list (see StateEncoder).
+        """
+        return self.encode_inputs(player_number).astype(np.int64).tolist()
 
-        for zone in player.board:
-            inputs.append(1 if zone.locked else 0)
-        
-        sorted_hand = sorted(player.hand, key=operator.attrgetter('name'))
-        sorted_discard = sorted(player.deck_discard, key=operator.attrgetter('name'))
-
-        # One-hot encode the cards in the hand
-        for i in range(0, 4):
-            card_inputs = [0] * num_cards
-            if i < len(sorted_hand):
-                card = sorted_hand[i]
-                card_inputs[self.card_encoding[card.name]] = 1           
-            inputs.extend(card_inputs)
-        
-                
-        # One-hot encode the cards in the discard pile
-        for i in range(0, 30):
-            card_inputs = [0] * num_cards
-            if i < len(sorted_discard):
-                card = sorted_discard[i]
-                card_inputs[self.card_encoding[card.name]] = 1           
-            inputs.extend(card_inputs)
-        
-        for other_player in self.players:
-            if other_player != player:
-                inputs.extend([1 if other_player == self.players[self.playerToMove] else 0, other_player.power])     
+    def encode_inputs(self, player_number, out=None):
+        """ The features of to_inputs() as a float32 array, written into out when it is given.
+        """
+        return state_encoder(self.card_encoding).encode(self, player_number, out)
+
+    @staticmethod
+    def encode_batch(states, players, out=None):
+        """ Encode each state from the viewpoint of the matching player (or of the one player given)
+            into the rows of a single (len(states), features) float32 array.
+        """
+        if isinstance(players, int):
+            players = [players] * len(states)
+        return state_encoder(states[0].card_encoding).encode_batch(states, players, out)
+
+_state_encoders = {}
+def state_encoder(card_encoding):
+    """ Return the StateEncoder for a card encoding, creating it on first use.
+    """
+    encoder = _state_encoders.get(id(card_encoding))
+    if encoder is None or encoder.card_encoding is not card_encoding:
+        encoder = _state_encoders[id(card_encoding)] = StateEncoder(card_encoding)
+    return encoder
+
+class StateEncoder:
+    """ Writes the features of VillainousStates straight into float32 NumPy rows, one row per state.
+        For the player being encoded: whether it is their turn, their power and which zones are locked,
+        then a one-hot row of the card encoding for each hand slot and each discard slot, with the cards
+        sorted by name. Each other player follows with the same features except the hand.
+    """
+    HAND_SLOTS = 4
+    DISCARD_SLOTS = 30
+    PLAYER_FEATURES = 6 # turn, power and 4 zone locks
+
+    def __init__(self, card_encoding):
+        self.card_encoding = card_encoding
+        self.num_cards = len(card_encoding)
+        self.registries = {} # CardRegistry -> (rank, code) tables, see _tables
+
+    def features(self, numberOfPlayers):
+        player = self.PLAYER_FEATURES + self.DISCARD_SLOTS * self.num_cards
+        return player + self.HAND_SLOTS * self.num_cards + (numberOfPlayers - 1) * player
+
+    def encode(self, state, player_number, out=None):
+        if out is None:
+            out = np.zeros(self.features(state.numberOfPlayers), dtype=np.float32)
+        self.encode_batch([state], [player_number], out.reshape(1, -1))
+        return out
+
+    def encode_batch(self, states, players, out=None):
+        if out is None:
+            out = np.zeros((len(states), self.features(states[0].numberOfPlayers)), dtype=np.float32)
+        else:
+            out[:] = 0
+        num_cards = self.num_cards
+        features = out.shape[1]
+        # Gather the index of every feature that is set, then write them all with one array assignment
+        index = []
+        values = []
+        ones = []
+        for row, (state, player_number) in enumerate(zip(states, players)):
+            player = state.players[player_number]
+            to_move = state.players[state.playerToMove]
+            offset = row * features
+            for other_player in [player] + [other for other in state.players if other != player]:
+                index.append(offset)
+                values.append(1 if other_player == to_move else 0)
+                index.append(offset + 1)
+                values.append(other_player.power)
+                offset += 2
                 for zone in other_player.board:
-                    inputs.append(1 if zone.locked else 0)
-                
-                # One-hot encode the cards in the opponent's discard pile
-                sorted_discard = sorted(other_player.deck_discard, key=operator.attrgetter('name'))
-                for i in range(0, 30):
-                    card_inputs = [0] * num_cards
-                    if i < len(sorted_discard):
-                        card = sorted_discard[i]
-                        card_inputs[self.card_encoding[card.name]] = 1           
-                    inputs.extend(card_inputs)
-        return inputs
+                    if zone.locked:
+                        ones.append(offset)
+                    offset += 1
+                piles = [(other_player.hand, self.HAND_SLOTS), (other_player.deck_discard, self.DISCARD_SLOTS)]
+                for pile, slots in piles if other_player is player else piles[1:]:
+                    rank, code = self._tables(pile.registry)
+                    for card_id in sorted(pile.ids, key=rank.__getitem__)[:slots]:
+                        if code[card_id] < 0:
+                            raise KeyError(pile.registry.cards[card_id].name)
+                        ones.append(offset + code[card_id])
+                        offset += num_cards
+                    offset += (slots - min(slots, len(pile))) * num_cards
+
+        flat = out.reshape(-1)
+        flat[index] = values
+        flat[ones] = 1
+        return out
+
+    def _tables(self, registry):
+        """ For each card ID of registry, the order of its name and its index in the card encoding (-1 if it has none).
+        """
+        tables = self.registries.get(registry)
+        if tables is None or len(tables[0]) != len(registry):
+            names = sorted({card.name for card in registry.cards})
+            name_rank = {name: i for i, name in enumerate(names)}
+            tables = self.registries[registry] = (
+                [name_rank[card.name] for card in registry.cards],
+                [self.card_encoding.get(card.name, -1) for card in registry.cards],
+            )
+        return tables
 
 def gold_stash(p, gs):
     p.add_power(2)
 
+def taxes(p, gs):
+    p.add_power(-3)
+
+def no_targets(p, gs):
+    return []
+
 def sacrifice_targets(p, gs):
     options = []
     skipped_sacrifices = False
@@ -330,7 +519,7 @@ def sacrifice_targets(p, gs):
             continue
         options.append(card)
     
-    return powerset(options)
+    return Subsets(options)
 
 def sacrifice(target, p, gs):
     for card in target:
@@ -353,9 +542,10 @@ class PlayerState:
             [[PowerAction(4), DiscardAction()], [MoveAllyAction(), PlayCardAction()]],
         ]
         self.identifier = identifier
-        self.hand = []
-        self.deck_discard = []
-        self.fate_discard = []
+        registry = Villain.card_registry()
+        self.hand = Pile(registry)
+        self.deck_discard = Pile(registry)
+        self.fate_discard = Pile(registry)
         
         self.vanquish_history = []
         
@@ -374,11 +564,11 @@ class PlayerState:
         self.can_stay_on_zone = False
         self.first_turn = True
         
-        self.deck = Villain.generate_deck() #deepcopy(Villain.generate_deck())
-        random.shuffle(self.deck)
+        self.deck = Villain.deck()
+        self.deck.shuffle()
         
-        self.fate = Villain.generate_fate() #deepcopy(Villain.generate_fate())
-        random.shuffle(self.fate)
+        self.fate = Villain.fate()
+        self.fate.shuffle()
         
         for i in range(4):
             self.draw_card()
@@ -393,6 +583,58 @@ class PlayerState:
         self.board_position = self.board[0]
         Villain.init(self)
     
+    def Clone(self):
+        """ Copy the piles, board and counters of this player, sharing the Villain, agent and cards off the board.
+        """
+        st = object.__new__(type(self))
+        st.__dict__.update(self.__dict__)
+        st.hand = self.hand.copy()
+        st.deck = self.deck.copy()
+        st.deck_discard = self.deck_discard.copy()
+        st.fate = self.fate.copy()
+        st.fate_discard = self.fate_discard.copy()
+        st.vanquish_history = self.vanquish_history.copy()
+        st.all_turn_records = self.all_turn_records.copy()
+        st.turn_record = self.turn_record.copy()
+        st.actions_performed = self.actions_performed.copy()
+        st.all_actions_performed = self.all_actions_performed.copy()
+        st.board = [zone.Clone() for zone in self.board]
+        st.board_position = st.board[self.board_position.number]
+        return st
+
+    def Snapshot(self, board=True):
+        """ Capture everything a move can change about this player, for VillainousState.UndoMove.
+            The zones are left out unless board is set.
+        """
+        return (self.hand.copy(), self.deck.copy(), self.deck_discard.copy(), self.fate.copy(), self.fate_discard.copy(),
+                len(self.vanquish_history), self.power, self.board_position, self.can_stay_on_zone, self.first_turn,
+                [zone.Snapshot() for zone in self.board] if board else None)
+
+    def Restore(self, snapshot):
+        (self.hand, self.deck, self.deck_discard, self.fate, self.fate_discard, vanquished, self.power,
+         self.board_position, self.can_stay_on_zone, self.first_turn, zones) = snapshot
+        del self.vanquish_history[vanquished:]
+        if zones is not None:
+            for zone, zone_snapshot in zip(self.board, zones):
+                zone.Restore(zone_snapshot)
+
+    def Hash(self, index):
+        """ The part of VillainousState.Hash() for this player, who is players[index].
+            Piles are hashed as multisets, as the order of the cards in them is hidden.
+        """
+        h = (ZobristKey("power", index, self.power)
+             ^ ZobristKey("position", index, self.board_position.number, self.can_stay_on_zone, self.first_turn))
+        # Multiplying by a different odd salt for each pile tells apart the same cards in different piles
+        for pile, salt in zip((self.hand, self.deck, self.deck_discard, self.fate, self.fate_discard), pile_salts(index)):
+            h ^= (pile.hash * salt) & HASH_MASK
+        vanquished = 0
+        for hero, zone in self.vanquish_history:
+            vanquished += ZobristKey("vanquished", index, hero.key(), zone)
+        board = 0
+        for zone in self.board:
+            board += zone.Hash(index)
+        return h ^ (vanquished & HASH_MASK) ^ (board & HASH_MASK)
+
     def available_zones(self):
         positions = []
         for zone in self.board:
@@ -410,9 +652,7 @@ class PlayerState:
             #random.shuffle(self.deck)
             self.deck_discard.clear()           
         
-        card = self.deck[0]
-        self.hand.append(card)
-        self.deck.remove(card)
+        self.hand.append(self.deck.pop(0))
 
     def get_fate_card(self):
         if len(self.fate) == 0:
@@ -421,9 +661,7 @@ class PlayerState:
             #random.shuffle(self.fate)
             self.fate_discard.clear()           
         
-        card = self.fate[0]
-        self.fate.remove(card)  
-        return card        
+        return self.fate.pop(0)
 
     def discard_card(self, card):
         self.deck_discard.append(card)
@@ -462,17 +700,21 @@ class ISMCTSAgent(Agent):
 
 class RegressionAgent(Agent):
 
-    def __init__(self, verbose=True):
+    def __init__(self, verbose=True, model=None, transpositions=0):
         super().__init__()
         self.estimator = None
+        # Evaluates positions instead of estimator.model when set, e.g. a shared InferenceServer
+        self.model = model
         self.verbose = verbose
+        # With transpositions > 0, up to that many evaluations are kept and reused for positions seen again
+        self.table = TranspositionTable(transpositions) if transpositions > 0 else None
         
     def GetMove(self, state, moves=None):
         best_move = None
         best_val = 0
         
         #inputs = [state.Clone().DoMove(move).to_inputs(state.playerToMove) for move in state.GetMoves()]
-        inputs = []
+        future_states = []
         move_options = []
         if not moves:
             moves = state.GetMoves()
@@ -484,18 +726,16 @@ class RegressionAgent(Agent):
                 for second_move in future_state.GetMoves():
                     second_future_state = future_state.CloneAndRandomize(state.playerToMove)
                     second_future_state.DoMove(second_move)
-                    inputs.append(second_future_state.to_inputs(state.playerToMove))
+                    future_states.append(second_future_state)
                     move_options.append(move)
                     
             else:
-                inputs.append(future_state.to_inputs(state.playerToMove))
+                future_states.append(future_state)
                 move_options.append(move)                          
         
         printed_moves = []
         index = 0
-        predictions = self.estimator.model(np.array(inputs), training=False)#self.estimator.predict(inputs, verbose=0)       
-        if len(inputs) == 1:
-            predictions = [predictions]
+        predictions = self.Evaluate(future_states, state.playerToMove)
         for prediction in predictions:
             if prediction > best_val or best_move is None:
                 best_val = prediction
@@ -509,6 +749,25 @@ class RegressionAgent(Agent):
             print(f"\nBest Move: {best_move}\n")# ({best_val*100:.1f}%)\n")
         return best_move
 
+    def Evaluate(self, states, player):
+        """ The model's predictions for states from the viewpoint of player, with one model call
+            for all the states that are not already in the transposition table.
+        """
+        keys = [None] * len(states) if self.table is None else [(state.Hash(), player) for state in states]
+        predictions = [None if key is None else self.table.get(key) for key in keys]
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if missing:
+            inputs = VillainousState.encode_batch([states[i] for i in missing], player)
+            model = self.model if self.model is not None else self.estimator.model
+            outputs = model(inputs, training=False)#self.estimator.predict(inputs, verbose=0)
+            if len(inputs) == 1:
+                outputs = [outputs]
+            for i, output in zip(missing, outputs):
+                predictions[i] = output
+                if keys[i] is not None:
+                    self.table.put(keys[i], output)
+        return predictions
+
 class BoardZone:
     
     def __init__(self, number):
@@ -517,20 +776,129 @@ class BoardZone:
         self.actions = []
         self.actions_blockable = []
         self.locked = False
+        # (locked, no heroes, actions_granted of each item, available actions, power actions), see available_actions
+        self.actions_cache = None
         
         self.heroes = []
         self.allies = []
         self.items = []
     
+    def Clone(self):
+        """ Copy this zone, sharing its actions. Moves change the cards on the board (equipped items, current zone),
+            so each state has its own copies of them.
+        """
+        zone = object.__new__(type(self))
+        zone.__dict__.update(self.__dict__)
+        zone.heroes = [card.Clone() for card in self.heroes]
+        zone.allies = [card.Clone() for card in self.allies]
+        zone.items = [card.Clone() for card in self.items]
+        return zone
+
+    def position_of(self, card):
+        """ Return the position of card among the heroes, allies and items of this zone, in that order.
+        """
+        for position, c in enumerate(chain(self.heroes, self.allies, self.items)):
+            if c is card:
+                return position
+        return None
+
+    def get_card(self, key, position, taken=()):
+        """ Return the hero, ally or item of this zone that a move targets, given the board_card_key and
+            position_of of the card when the move was generated. Moves keep references to the cards of the
+            state they were generated from, while a clone has its own copies, so they find the card again
+            by position. If the card there has another key (the move came from a different determinization),
+            the first card with that key not in taken is used instead.
+        """
+        cards = self.heroes + self.allies + self.items
+        if position is not None and position < len(cards):
+            card = cards[position]
+            if board_card_key(card) == key and not any(card is t for t in taken):
+                return card
+        for card in cards:
+            if board_card_key(card) == key and not any(card is t for t in taken):
+                return card
+        return None
+
+    def remove_card(self, card):
+        """ Take card itself out of this zone. Unlike list.remove, this never takes out another card equal to it.
+        """
+        for cards in (self.heroes, self.allies, self.items):
+            for i, c in enumerate(cards):
+                if c is card:
+                    del cards[i]
+                    return
+        raise ValueError(f"{card} is not in zone {self.number}")
+
+    def Snapshot(self):
+        """ Capture the cards in this zone, and the items and zone of each of them, for PlayerState.Restore.
+        """
+        return (copy(self.heroes), copy(self.allies), copy(self.items), self.locked,
+                [(card, copy(card.items), card.current_zone) for card in chain(self.heroes, self.allies, self.items)])
+
+    def Restore(self, snapshot):
+        self.heroes, self.allies, self.items, self.locked, cards = snapshot
+        for card, items, current_zone in cards:
+            card.items = items
+            card.current_zone = current_zone
+
+    def Hash(self, player_index):
+        """ The part of PlayerState.Hash() for this zone of players[player_index]: whether it is locked,
+            and the heroes, allies and items in it with the items equipped to each. Returned as a sum,
+            so the zones of a player can be added up.
+        """
+        h = ZobristKey("locked", player_index, self.number) if self.locked else 0
+        for name, cards in (("heroes", self.heroes), ("allies", self.allies), ("items", self.items)):
+            if cards:
+                salt = ZobristKey("zone", player_index, self.number, name) | 1
+                for card in cards:
+                    key = card_zobrist(card)
+                    if card.items:
+                        equipped = 0
+                        for item in card.items:
+                            equipped += card_zobrist(item)
+                        key += MixHash(equipped & HASH_MASK)
+                    h += key * salt
+        return h
+
     def available_actions(self):
+        """ The actions of this zone that can be taken, as a tuple: none while it is locked, the blockable ones
+            only while it has no heroes, and those granted by its items. The tuple is kept until the lock, the
+            heroes or the items change, and is shared with the clones of the zone.
+        """
+        cache = self.actions_cache
+        if (cache is None or cache[0] != self.locked or cache[1] != (not self.heroes)
+                or ((cache[2] or self.items) and self.items_changed(cache[2]))):
+            cache = self.cache_actions()
+        return cache[3]
+
+    def power_actions(self):
+        """ The PowerActions among available_actions(). """
+        self.available_actions()
+        return self.actions_cache[4]
+
+    def items_changed(self, granted):
+        if len(granted) != len(self.items):
+            return True
+        # Clones of an item share its actions_granted list, so the items are compared through them
+        for item, item_granted in zip(self.items, granted):
+            if item.actions_granted is not item_granted:
+                return True
+        return False
+
+    def cache_actions(self):
         if self.locked:
-            return []
-        item_bonus = []
-        for item in self.items:
-            item_bonus.extend(item.actions_granted)
-        if len(self.heroes) > 0:
-            return self.actions + item_bonus
-        return self.actions + self.actions_blockable + item_bonus
+            actions = ()
+        else:
+            item_bonus = []
+            for item in self.items:
+                item_bonus.extend(item.actions_granted)
+            if len(self.heroes) > 0:
+                actions = tuple(self.actions + item_bonus)
+            else:
+                actions = tuple(self.actions + self.actions_blockable + item_bonus)
+        power_actions = tuple(action for action in actions if type(action) is PowerAction)
+        self.actions_cache = (self.locked, not self.heroes, tuple(item.actions_granted for item in self.items), actions, power_actions)
+        return self.actions_cache
     
     def __eq__(self, other):
         if self is None and other is None:
@@ -562,7 +930,7 @@ class Card:
         self.card_type = card_type
         self.code = None
         self.targeted = False
-        self.target_set = lambda: []
+        self.target_set = no_targets
         self.fate = False
         
         # Item Settings
@@ -575,8 +943,13 @@ class Card:
         self.items = []
         self.current_zone = -1
         self.adjacent_vanquish = False
+        
+        # Set once the card is a definition in a CardRegistry
+        self.registry = None
+        self.card_id = None
     
     def play(self, player, game_state, target=None, zone=None):
+        # Cards in piles are shared between cloned states, so each state puts its own copy on the board
         if self.card_type == CardType.EFFECT:
             if self.code is not None:
                 if self.targeted:
@@ -589,20 +962,28 @@ class Card:
                     print(f"Card {self} given no target despite being an equip item")
                 target.items.append(self)
             else:
-                zone.items.append(self)
+                zone.items.append(self.Clone())
                 if self.code is not None:
                     self.code(player, game_state)
         elif not self.card_type == CardType.CONDITION:
             if self.fate:
-                zone.heroes.append(self)
+                zone.heroes.append(self.Clone())
             else:
-                zone.allies.append(self)
+                zone.allies.append(self.Clone())
         elif self.card_type == CardType.CONDITION:
             pass
         else:
             print(f"ERROR: Don't know what to do with card. Name={self.name}, type={self.card_type}")
         return None
 
+    def Clone(self):
+        """ Copy the per-game parts of this card (its equipped items and zone), sharing everything else.
+        """
+        card = object.__new__(type(self))
+        card.__dict__.update(self.__dict__)
+        card.items = self.items.copy()
+        return card
+
     def get_total_strength(self, zone):
         strength = self.strength
         for item in self.items:
@@ -623,14 +1004,205 @@ class Card:
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def key(self):
+        """ The identity of a card as far as equality is concerned. """
+        return (self.name, self.cost, self.card_type)
+
+    def definition(self):
+        """ Everything that is fixed about this card. Unlike key(), this tells apart cards that share a name
+            but not their abilities (such as the two Cannons, which grant differently numbered actions).
+        """
+        actions = tuple((type(action), action.number, getattr(action, "power", None)) for action in self.actions_granted)
+        return (self.key(), self.code, self.targeted, self.target_set, self.fate, self.equip, self.strength_bonus,
+                self.strength, self.adjacent_vanquish, actions)
+
     def __hash__(self):
-        return hash((self.name, self.cost, self.card_type))
+        return hash(self.key())
+
+class CardRegistry:
+    """ Assigns a small integer ID to each distinct card definition, so piles can store IDs instead of Card objects.
+        The registered Card for an ID is shared by every pile and state holding that ID, and is never changed.
+    """
+
+    def __init__(self, cards=()):
+        self.cards = [] # ID -> Card
+        self.ids = {} # Card.definition() -> ID
+        self.keys = [] # ID -> Zobrist key, see card_zobrist
+        for card in cards:
+            self.register(card)
+
+    def register(self, card):
+        """ Return the ID of card's definition, registering it first if it is new.
+        """
+        definition = card.definition()
+        card_id = self.ids.get(definition)
+        if card_id is None:
+            card_id = len(self.cards)
+            definition_card = card.Clone()
+            definition_card.items = []
+            definition_card.current_zone = -1
+            definition_card.registry = self
+            definition_card.card_id = card_id
+            self.cards.append(definition_card)
+            self.ids[definition] = card_id
+            self.keys.append(card_zobrist(card))
+        return card_id
+
+    def id_of(self, card):
+        return card.card_id if card.registry is self else self.register(card)
+
+    def __len__(self):
+        return len(self.cards)
+
+_pile_salts = {}
+def pile_salts(index):
+    """ The odd Zobrist keys that the hand, deck, deck discard, fate and fate discard sums of players[index] are multiplied by.
+    """
+    salts = _pile_salts.get(index)
+    if salts is None:
+        salts = _pile_salts[index] = tuple(ZobristKey("pile", index, name) | 1 for name in ("hand", "deck", "deck_discard", "fate", "fate_discard"))
+    return salts
+
+def card_zobrist(card):
+    """ The Zobrist key of a card, the same for every copy of it. Cards that share a key() but grant
+        different actions (the two Cannons) get different keys.
+    """
+    if card.registry is not None:
+        return card.registry.keys[card.card_id]
+    actions = tuple((type(action).__name__, action.number, getattr(action, "power", None)) for action in card.actions_granted)
+    return ZobristKey("card", card.key(), actions)
+
+class Pile:
+    """ An ordered pile of cards (a hand, deck or discard pile), stored as an array of CardRegistry IDs.
+        It reads like a list of Card objects, but copies and shuffles only move the IDs.
+        hash is the sum of the Zobrist keys of the cards, kept up to date as cards are added and removed.
+    """
+    __slots__ = ("registry", "ids", "hash")
+
+    def __init__(self, registry, cards=()):
+        self.registry = registry
+        self.ids = array("H", [registry.id_of(card) for card in cards])
+        self.hash = self._sum(self.ids)
+
+    @staticmethod
+    def from_ids(registry, ids):
+        """ A pile of the cards of registry with the given IDs. """
+        return Pile(registry)._with_ids(array("H", ids))
+
+    def _sum(self, ids):
+        keys = self.registry.keys
+        return sum(keys[card_id] for card_id in ids) & HASH_MASK
+
+    def _with_ids(self, ids, hash=None):
+        pile = object.__new__(Pile)
+        pile.registry = self.registry
+        pile.ids = ids
+        pile.hash = self._sum(ids) if hash is None else hash
+        return pile
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return map(self.registry.cards.__getitem__, self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._with_ids(self.ids[index])
+        return self.registry.cards[self.ids[index]]
+
+    def __setitem__(self, index, card):
+        card_id = self.registry.id_of(card)
+        keys = self.registry.keys
+        self.hash = (self.hash - keys[self.ids[index]] + keys[card_id]) & HASH_MASK
+        self.ids[index] = card_id
+
+    def __contains__(self, card):
+        return any(other == card for other in self)
+
+    def __add__(self, other):
+        pile = self.copy()
+        pile.extend(other)
+        return pile
+
+    def copy(self):
+        return self._with_ids(self.ids[:], self.hash)
+
+    __copy__ = copy
+
+    def __repr__(self):
+        return f"Pile([{', '.join(str(card) for card in self)}])"
+
+    def append(self, card):
+        card_id = self.registry.id_of(card)
+        self.ids.append(card_id)
+        self.hash = (self.hash + self.registry.keys[card_id]) & HASH_MASK
+
+    def extend(self, cards):
+        if isinstance(cards, Pile) and cards.registry is self.registry:
+            self.ids.extend(cards.ids)
+            self.hash = (self.hash + cards.hash) & HASH_MASK
+        else:
+            for card in cards:
+                self.append(card)
+
+    def pop(self, index=-1):
+        card_id = self.ids.pop(index)
+        self.hash = (self.hash - self.registry.keys[card_id]) & HASH_MASK
+        return self.registry.cards[card_id]
+
+    def remove(self, card):
+        """ Remove the first copy of card, or failing that the first card equal to it (see Card.__eq__).
+        """
+        card_id = self.registry.id_of(card)
+        if card_id not in self.ids:
+            card_id = next((other.card_id for other in self if other == card), None)
+            if card_id is None:
+                raise ValueError(f"{card} is not in the pile")
+        self.ids.remove(card_id)
+        self.hash = (self.hash - self.registry.keys[card_id]) & HASH_MASK
+
+    def clear(self):
+        del self.ids[:]
+        self.hash = 0
+
+    def shuffle(self):
+        random.shuffle(self.ids)
+
+_action_bits = {} # Action.key() -> bit
+_action_keys = {} # bit -> Action.key()
+
+def used_action_keys(actions_used):
+    """ The keys of the actions in an actions_used bitmask. """
+    while actions_used:
+        bit = actions_used & -actions_used
+        yield _action_keys[bit]
+        actions_used ^= bit
+
+def action_bit(key):
+    """ The bit of the actions with the given key in VillainousState.actions_used, assigned on first use.
+        Processes can assign different bits to the same key, so masks only leave a process as keys.
+    """
+    bit = _action_bits.get(key)
+    if bit is None:
+        bit = _action_bits[key] = 1 << len(_action_bits)
+        _action_keys[bit] = key
+    return bit
 
 class Action:
 
     def __init__(self, number=0):
         self.choice = -1
         self.number = number
+        # Equal actions share a bit (bits are assigned per process, so unpickling assigns it again)
+        self.bit = action_bit(self.key())
+
+    def key(self):
+        return (type(self).__name__, self.number)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bit = action_bit(self.key())
 
     def __str__(self):
         if self.choice:
@@ -652,12 +1224,15 @@ class MovePlayerAction(Action):
 class PowerAction(Action):
 
     def __init__(self, power, number=0):
-        super().__init__(number=number)
         self.power = power
+        super().__init__(number=number)
 
     def  __str__(self):
         return f"{self.power} Power Action"
 
+    def key(self):
+        return super().key() + (self.power,)
+
     def __eq__(self, other):
         return super().__eq__(other) and self.power == other.power
         
@@ -707,75 +1282,145 @@ def unlock_the_magic(p, gs):
                 p.fate_discard.append(hero)
                 return
 
+VILLAINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "villains.json")
+
+CARD_FIELDS = ("code", "targeted", "target_set", "fate", "equip", "strength_bonus", "strength", "adjacent_vanquish")
+
+def resolve_effect(reference):
+    """ Return the function a villain file refers to by name: "gold_stash" for a function in this module,
+        or "module.function" for one defined elsewhere, such as "hook.worthy_opponent".
+    """
+    module_name, _, function_name = reference.rpartition(".")
+    module = importlib.import_module(module_name) if module_name else sys.modules[__name__]
+    return getattr(module, function_name)
+
+def compile_card(spec, fate):
+    """ Build the template Card described by spec, a card entry of a villain file.
+        fate is the default for the card's fate flag: True for the cards of the fate deck.
+    """
+    unknown = set(spec) - {"name", "cost", "type", "count", "actions_granted", "todo"} - set(CARD_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields for card {spec.get('name')}: {', '.join(sorted(unknown))}")
+    card = Card(spec["cost"], spec["name"], getattr(CardType, spec["type"]))
+    card.fate = fate
+    for field in CARD_FIELDS:
+        if field in spec:
+            value = spec[field]
+            setattr(card, field, resolve_effect(value) if field in ("code", "target_set") else value)
+    for action in spec.get("actions_granted", []):
+        arguments = {name: value for name, value in action.items() if name != "type"}
+        card.actions_granted.append(globals()[action["type"]](**arguments))
+    return card
+
+def compile_pile(specs, registry, fate):
+    """ The card IDs of a deck listed in a villain file, registering each distinct card in registry.
+        An entry is a card, repeated count times, or a group {"repeat": n, "cards": [...]} of entries
+        listed n times over, for cards that are shuffled in a set order.
+    """
+    ids = array("H")
+    for spec in specs:
+        if "repeat" in spec:
+            for i in range(spec["repeat"]):
+                ids.extend(compile_pile(spec["cards"], registry, fate))
+        else:
+            card_id = registry.register(compile_card(spec, fate))
+            ids.extend([card_id] * spec.get("count", 1))
+    return ids
+
+class VillainTemplate:
+    """ A villain compiled from its entry in a villain file: a CardRegistry of its distinct cards,
+        the card IDs its deck and fate deck start with, the zones locked at the start and its win conditions.
+        Templates are shared by every game; players only copy the IDs of the decks.
+    """
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.registry = CardRegistry()
+        self.deck_ids = compile_pile(spec["deck"], self.registry, fate=False)
+        self.fate_ids = compile_pile(spec["fate"], self.registry, fate=True)
+        self.locked_zones = tuple(spec.get("locked_zones", ()))
+        win = spec.get("win", {})
+        self.min_power = win.get("min_power")
+        self.max_heroes = win.get("max_heroes")
+        self.vanquish = {tuple(entry) for entry in win.get("vanquish", ())}
+
+    def deck(self):
+        return Pile.from_ids(self.registry, self.deck_ids)
+
+    def fate(self):
+        return Pile.from_ids(self.registry, self.fate_ids)
+
+    def has_won(self, player_state):
+        """ Whether player_state meets every win condition of the villain: at least min_power power,
+            at most max_heroes heroes on the board and a vanquish of one of the (hero name, zone) pairs listed.
+        """
+        if self.min_power is not None and player_state.power < self.min_power:
+            return False
+        if self.max_heroes is not None and sum(len(zone.heroes) for zone in player_state.board) > self.max_heroes:
+            return False
+        if self.vanquish and not any((hero.name, zone) in self.vanquish for hero, zone in player_state.vanquish_history):
+            return False
+        return True
+
+_villain_files = {}
+def load_villains(path=VILLAINS_FILE):
+    """ Return the VillainTemplates defined in a villain file by name, compiling the file on first use.
+    """
+    villains = _villain_files.get(path)
+    if villains is None:
+        with open(path) as f:
+            specs = json.load(f)
+        villains = _villain_files[path] = {name: VillainTemplate(name, spec) for name, spec in specs.items()}
+    return villains
+
 class Villain:
+    """ A villain played from its definition in a villain file. The name defaults to that of the class, so
+        subclasses like hook.CaptainHook need no code of their own; Villain("Name") plays any villain in the file.
+    """
+
+    def __init__(self, name=None, path=VILLAINS_FILE):
+        self.name = name if name is not None else type(self).__name__
+        self.template = load_villains(path)[self.name]
     
     def init(self, player):
-        player.board[3].locked = True
+        for zone in self.template.locked_zones:
+            player.board[zone].locked = True
+    
+    def card_registry(self):
+        """ Return the CardRegistry of this villain's cards, shared by every player with the same villain.
+        """
+        return self.template.registry
     
+    def deck(self):
+        """ A new, unshuffled Pile of the villain's deck. """
+        return self.template.deck()
+
+    def fate(self):
+        """ A new, unshuffled Pile of the villain's fate deck. """
+        return self.template.fate()
+
     def generate_deck(self):
-        deck = []
-        for i in range(30):
-            card = None
-            if i < 10:
-                card = Card(1, "Gold Stash", CardType.EFFECT)
-                card.code = gold_stash
-            elif i < 19:
-                card = Card(3, "Sacrifices", CardType.EFFECT)
-                card.code = sacrifice
-                card.targeted = True
-                card.target_set = sacrifice_targets
-            elif i <= 27:
-                card = Card(0, "Gremlin", CardType.ALLY)
-                card.strength = 3
-            else:
-                card = Card(2, "Unlock the Magic", CardType.EFFECT)
-                card.code = unlock_the_magic
-            if card:
-                deck.append(card)
-        #for i in range(1, 7):
-            #card = Card(2, "Cannon", CardType.ITEM)
-           # card.actions_granted.append(VanquishAction(number=-i))
-            #deck.append(card)
-        return deck
+        return list(self.deck())
     
     def generate_fate(self):
-        fate = []
-        for i in range(20):
-            if i < 10:
-                card = Card(0, "Taxes", CardType.EFFECT)
-                card.code = lambda p, gs: p.add_power(-3)
-                card.fate = True
-            elif i < 18:
-                card = Card(0, "Politician", CardType.HERO)
-                card.strength = 2
-                card.fate = True
-            else:
-                card = Card(0, "Chungus", CardType.ALLY)
-                card.strength = 6
-                card.fate = True
-            if card:
-                fate.append(card)
-        return fate
+        return list(self.fate())
 
     def get_score(self, player_state):
         return player_state.power
 
     def has_won(self, player_state, game_state):
-        heroes = 0
-        for zone in player_state.board:
-            heroes += len(zone.heroes)
-        return player_state.power >= 15 and heroes <= 1
+        return self.template.has_won(player_state)
 
 def encode_cards(state):
-    unique = []
-    cards = []
+    # The first card with each key, in the order they appear in the piles (cards equal by Card.__eq__ share a key)
+    unique = {}
     for player in state.players:
-        cards.extend(player.hand + player.deck_discard + player.deck + player.fate + player.fate_discard)
-    for card in cards:
-        if card not in unique:
-            unique.append(card)
+        for pile in (player.hand, player.deck_discard, player.deck, player.fate, player.fate_discard):
+            for card_id in dict.fromkeys(pile.ids):
+                card = pile.registry.cards[card_id]
+                unique.setdefault(card.key(), card)
     
-    unique = sorted(unique, key=operator.attrgetter('name'))
+    unique = sorted(unique.values(), key=operator.attrgetter('name'))
     
     encodings = {}
     num = 0
@@ -0,0 +1,84 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+
+class InferenceServer:
+    """ Shares one model between many concurrent searches by coalescing their evaluation requests.
+        Requests are queued with submit() and a background thread evaluates whatever has arrived,
+        up to max_batch_size rows or max_wait_ms after the first request, in a single model call.
+
+        The server also offers predict() and __call__() like a Keras model, so it can be handed to
+        AlphaMCTSAgent or RegressionAgent in place of the model they would otherwise call directly:
+
+            server = InferenceServer(get_model(1))
+            agents = [AlphaMCTSAgent(model=server, batch_size=16), Agent()]
+    """
+
+    def __init__(self, model, max_batch_size=512, max_wait_ms=2):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.calls = 0
+        self.rows = 0
+        self.thread = threading.Thread(target=self._Serve, daemon=True)
+        self.thread.start()
+
+    def submit(self, inputs):
+        """ Queue a batch of input rows for evaluation and return a Future of the matching output rows.
+        """
+        future = Future()
+        self.requests.put((np.asarray(inputs), future))
+        return future
+
+    def predict(self, inputs, verbose=0):
+        return self.submit(inputs).result()
+
+    def __call__(self, inputs, training=False):
+        return self.predict(inputs)
+
+    def close(self):
+        """ Stop the serving thread once the requests already queued have been answered.
+        """
+        self.requests.put(None)
+        self.thread.join()
+
+    def _Serve(self):
+        closing = False
+        while not closing:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch = [request]
+            rows = len(request[0])
+            deadline = time.perf_counter() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+                rows += len(request[0])
+            self._Evaluate(batch)
+
+    def _Evaluate(self, batch):
+        try:
+            outputs = np.asarray(self.model.predict(np.concatenate([inputs for inputs, future in batch]), verbose=0))
+        except Exception as e:
+            for inputs, future in batch:
+                future.set_exception(e)
+            return
+        self.calls += 1
+        self.rows += len(outputs)
+        offset = 0
+        for inputs, future in batch:
+            future.set_result(outputs[offset:offset + len(inputs)])
+            offset += len(inputs)
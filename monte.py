@@ -17,19 +17,18 @@
 
 from math import *
 import random, sys
+import hashlib
+from collections import OrderedDict
 from copy import deepcopy
-from numpy import loadtxt
 import numpy as np
-from tensorflow.keras import datasets, layers, models
-from keras.models import Sequential, load_model
-from keras.layers import Dense
-from keras.wrappers.scikit_learn import KerasRegressor
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import cross_val_score
-from sklearn.model_selection import KFold
-import tensorflow as tf
 import os
 import time
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from arraytree import ArrayTree
+from moves import MoveList
+from dataset import open_dataset, state_features
+from npmodel import export_model, load_numpy_model
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
 class GameState:
@@ -59,29 +58,117 @@ class GameState:
         """ Create a deep clone of this game state, randomizing any information not visible to the specified observer player.
         """
         return self.Clone()
-    
+
+    def Randomize(self, observer):
+        """ Randomize, in place, any information not visible to the specified observer player.
+            Needed by ISMCTS(..., in_place=True) instead of CloneAndRandomize.
+        """
+        pass
+
     def DoMove(self, move):
         """ Update a state by carrying out the given move.
             Must update playerToMove.
         """
         self.playerToMove = self.GetNextPlayer(self.playerToMove)
-        
+
+    def DoUndoableMove(self, move):
+        """ Carry out the given move like DoMove, and return a token that UndoMove can use to take it back.
+        """
+        token = self.playerToMove
+        self.DoMove(move)
+        return token
+
+    def UndoMove(self, token):
+        """ Restore the state from before the DoUndoableMove call that returned token.
+            Moves must be undone in the reverse of the order they were done in.
+        """
+        self.playerToMove = token
+
     def GetMoves(self):
         """ Get all possible moves from this state.
         """
         raise NotImplementedException()
     
+    def IsTerminal(self):
+        """ Return whether the game is over. Override this when it can be answered without listing the moves.
+        """
+        return not self.GetMoves()
+
+    def GetRandomMove(self):
+        """ Return a random move from GetMoves(), or None if the game is over.
+            Override this when a random move can be drawn without listing every move.
+        """
+        moves = self.GetMoves()
+        return random.choice(moves) if moves else None
+
+    def DoRandomRollout(self, max_moves=None):
+        """ Play random moves until the game is over, or until max_moves moves were made.
+            Return whether the game is over. Used by ISMCTS for the simulate phase.
+        """
+        played = 0
+        move = self.GetRandomMove()
+        while move is not None:
+            if played == max_moves:
+                return False
+            self.DoMove(move)
+            played += 1
+            move = self.GetRandomMove()
+        return True
+
     def GetResult(self, player):
         """ Get the game result from the viewpoint of player. 
         """
         raise NotImplementedException()
 
+    def Hash(self):
+        """ Return a 64-bit hash that is equal for equal positions, however they were reached,
+            or None if the state can't be hashed. Used as the key of a TranspositionTable.
+        """
+        return None
+
+    def CanonicalHash(self):
+        """ Return (hash, mirrored): a Hash() shared by this position and its mirror image, and whether it is
+            the mirror image's. Games with a left-right symmetry override this, and MirrorPolicy, so that a
+            TranspositionTable keeps one evaluation for both.
+        """
+        return self.Hash(), False
+
+    def MirrorPolicy(self, policy):
+        """ Return policy, a prior per move, as it is for the mirror image of this position.
+        """
+        raise NotImplementedException()
+
     def __repr__(self):
         """ Don't need this - but good style.
         """
         pass
 
 
+_keyed_move_types = {}
+def MoveKey(move):
+    """ Return a hashable key identifying move. Moves that provide a key() method (see moves.py)
+        are identified by it, anything else (column numbers, UCI strings, Uno cards) by itself.
+    """
+    move_type = type(move)
+    keyed = _keyed_move_types.get(move_type)
+    if keyed is None:
+        keyed = _keyed_move_types[move_type] = hasattr(move_type, "key")
+    return move.key() if keyed else move
+
+def RandomUntriedMove(legalMoves, childIndex):
+    """ A random element of legalMoves whose MoveKey is not in childIndex, or None if there is none.
+        When more than half of the moves are untried a few random draws almost always find one, so
+        the moves of a lazy MoveList are only all built once a node is close to fully expanded.
+    """
+    size = len(legalMoves)
+    if size > 2 * len(childIndex):
+        for attempt in range(4):
+            move = legalMoves[random.randrange(size)]
+            if MoveKey(move) not in childIndex:
+                return move
+    untriedMoves = [move for move in legalMoves if MoveKey(move) not in childIndex]
+    return random.choice(untriedMoves) if untriedMoves else None
+
 class Node:
     """ A node in the game tree. Note wins is always from the viewpoint of playerJustMoved.
     """
@@ -89,6 +176,7 @@ class Node:
         self.move = move # the move that got us to this node - "None" for the root node
         self.parentNode = parent # "None" for the root node
         self.childNodes = []
+        self.childIndex = {} # MoveKey(child.move) -> child
         self.wins = 0
         self.visits = 0
         self.avails = 1
@@ -105,11 +193,23 @@ class Node:
         """ Return the elements of legalMoves for which this node does not have children.
         """
         
-        # Find all moves for which this node *does* have children
-        triedMoves = [child.move for child in self.childNodes]
-        
         # Return all moves that are legal but have not been tried yet
-        return [move for move in legalMoves if move not in triedMoves]
+        return [move for move in legalMoves if MoveKey(move) not in self.childIndex]
+    
+    def GetUntriedMove(self, legalMoves):
+        """ Return a random element of legalMoves for which this node does not have a child, or None if there is none.
+            While most moves are untried, one is drawn directly instead of building the whole of a MoveList.
+        """
+        return RandomUntriedMove(legalMoves, self.childIndex)
+
+    def GetLegalChildren(self, legalMoves):
+        """ Return the children of this node whose moves are in legalMoves.
+        """
+        if isinstance(legalMoves, MoveList):
+            # Look each child up rather than building every move of the list
+            return [child for child in self.childNodes if child.move in legalMoves]
+        legalKeys = {MoveKey(move) for move in legalMoves}
+        return [child for key, child in self.childIndex.items() if key in legalKeys]
         
     def UCBSelectChild(self, legalMoves, exploration = 0.7):
         """ Use the UCB1 formula to select a child node, filtered by the given list of legal moves.
@@ -117,7 +217,7 @@ class Node:
         """
         
         # Filter the list of children by the list of legal moves
-        legalChildren = [child for child in self.childNodes if child.move in legalMoves]
+        legalChildren = self.GetLegalChildren(legalMoves)
         
         # Get the child with the highest UCB score
         s = max(legalChildren, key = lambda c: float(c.wins)/float(c.visits) + exploration * sqrt(log(c.avails)/float(c.visits)))
@@ -131,7 +231,7 @@ class Node:
     
     def NNSelectChild(self, legalMoves, exploration = 0.7):       
         # Filter the list of children by the list of legal moves
-        legalChildren = [child for child in self.childNodes if child.move in legalMoves]
+        legalChildren = self.GetLegalChildren(legalMoves)
         
         child_visits_sum = 0
         for child in legalChildren:
@@ -153,8 +253,19 @@ class Node:
         """
         n = Node(move = m, parent = self, playerJustMoved = p)
         self.childNodes.append(n)
+        self.childIndex[MoveKey(m)] = n
         return n
     
+    def GetChild(self, move):
+        """ Return the child node for move, or None if it has not been expanded.
+        """
+        return self.childIndex.get(MoveKey(move))
+    
+    def Detach(self):
+        """ Make this node the root of its own tree, so a later search can continue from it.
+        """
+        self.parentNode = None
+    
     def Update(self, terminalState):
         """ Update this node - increment the visit count by one, and increase the win count by the result of terminalState for self.playerJustMoved.
         """
@@ -190,13 +301,134 @@ class Node:
             s += str(c) + "\n"
         return s
 
-def get_model(model_type, train=False):
+def MakeRootNode(backend="object"):
+    """ Return an empty root node for the chosen tree backend: "object" builds a graph of Node
+        objects, "array" stores the whole tree in the NumPy arrays of an ArrayTree. Both search the
+        same way. "array" selects among many children faster, and pays off for wide trees such as
+        Villainous'; with the few children of a Connect Four node, "object" is faster.
+    """
+    if backend == "object":
+        return Node()
+    elif backend == "array":
+        return ArrayTree().root
+    raise ValueError(f"Unknown tree backend '{backend}'")
+
+class SearchBudget:
+    """ Decides when a search should stop: after itermax iterations, or once time_budget_ms
+        milliseconds (measured on a monotonic clock from construction) have passed. Either limit may be None,
+        but not both. Neither stops a search before min_iterations iterations were run, and every search
+        runs at least one, so that it has a move to return.
+    """
+    def __init__(self, itermax, time_budget_ms=None, min_iterations=1):
+        if itermax is None and time_budget_ms is None:
+            raise ValueError("A search needs itermax, time_budget_ms or both")
+        self.min_iterations = max(1, min_iterations)
+        self.itermax = None if itermax is None else max(itermax, self.min_iterations)
+        self.deadline = None if time_budget_ms is None else time.perf_counter() + time_budget_ms / 1000
+
+    def Exhausted(self, iterations):
+        if self.itermax is not None and iterations >= self.itermax:
+            return True
+        return self.deadline is not None and iterations >= self.min_iterations and time.perf_counter() >= self.deadline
+
+class UnfinishedRollout:
+    """ Stands in for the final state of a rollout stopped by ISMCTS's rollout_moves, which counts as a draw.
+    """
+    def GetResult(self, player):
+        return 0
+
+HASH_MASK = (1 << 64) - 1
+
+_zobrist_keys = {}
+def ZobristKey(*feature):
+    """ Return the random 64-bit Zobrist key for a feature of a position, e.g. ("power", player, 3).
+        Keys are derived from the feature itself rather than drawn in order, so every process agrees on them.
+    """
+    key = _zobrist_keys.get(feature)
+    if key is None:
+        digest = hashlib.blake2b(repr(feature).encode(), digest_size=8).digest()
+        key = _zobrist_keys[feature] = int.from_bytes(digest, "little")
+    return key
+
+def MixHash(value):
+    """ Scramble a 64-bit value (the splitmix64 finalizer). Sums of Zobrist keys are mixed before
+        being combined with other parts of a hash, so that equal sums in different places don't cancel.
+    """
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & HASH_MASK
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & HASH_MASK
+    return value ^ (value >> 31)
+
+class TranspositionTable:
+    """ A bounded map from position hashes (see GameState.Hash) to whatever a search wants to reuse for them,
+        such as network evaluations. Once capacity entries are stored, the least recently used one is evicted.
+    """
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self.entries.get(key, self)
+        if value is self:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+def FitDataset(estimator, dataset, board_shape=None, augment=None):
+    """ Train a KerasRegressor on a ShardedDataset with the epochs and batch_size it was made with, streaming
+        shuffled batches from disk rather than loading the dataset into memory.
+        augment, if given, maps each (inputs, targets) batch to the batch to train on, e.g. adding symmetries.
+    """
+    batch_size = estimator.sk_params["batch_size"]
+    batches = dataset.batches(batch_size, epochs=None, board_shape=board_shape)
+    if augment is not None:
+        batches = (augment(inputs, targets) for inputs, targets in batches)
+    estimator.model = estimator.build_fn()
+    estimator.model.fit(batches, steps_per_epoch=dataset.steps(batch_size),
+                        epochs=estimator.sk_params["epochs"], verbose=estimator.sk_params.get("verbose", 1))
+
+def get_model(model_type, train=False, data='game.txt', augment=True, engine="keras"):
+    """ Load (or with train, train) a Connect Four model: 0 is the flat model, 1 the convolutional one.
+        data is a shard directory or a CSV like game.txt, which is converted to shards once (see open_dataset).
+        With augment, every batch is trained on together with its mirror image.
+        A trained model is saved both for Keras (.h5) and for npmodel (.npz). With engine="numpy" the saved
+        model is loaded as an npmodel.NumpyModel, which evaluates small batches much faster and without TensorFlow.
+    """
+    if engine == "numpy" and not train:
+        if model_type not in (0, 1):
+            return None
+        return load_numpy_model(("Con4_Flat_Recent.npz", "Con4_Conv_Recent.npz")[model_type])
+    # TensorFlow takes seconds to import, so only processes that need it do
+    from tensorflow.keras import layers, models
+    from keras.models import Sequential, load_model
+    from keras.layers import Dense
+    from keras.wrappers.scikit_learn import KerasRegressor
     if train:
-        dataset = loadtxt('game.txt', delimiter=',')
-        print(f"len: {len(dataset[0])}")
-        X = dataset[:,0:42] #42
-        Y = dataset[:,42:]
-        print(f"Top Y: {Y[0]}")
+        # 42 board cells, then the value and the 7 column policy
+        dataset = open_dataset(data, 42)
+        print(f"{len(dataset)} samples")
+        from connectfour import augment_batch
+        augment = augment_batch if augment else None
     
     def flat_model():
         model = Sequential()
@@ -222,50 +454,35 @@ def get_model(model_type, train=False):
         )
         model.summary()
         return model
-    
-    if train and model_type == 1:
-        boards = []
-        for data in X:
-            #print("=========Loading Board========")
-            board = []
-            prev = 0
-            row_sum = 0
-            for i in range(6):
-                row = data[prev:(i+1)*7]
-                board.append(row)
-                prev = (i+1)*7
-                #print(row)
-                row_sum += len(row)
-            boards.append(board)
-
-        boards = np.asarray(boards)    
-        boards = boards.reshape(len(boards), 6, 7, 1)
-        #print(boards)
         
     if model_type == 0:
         estimator = KerasRegressor(build_fn=flat_model, epochs=5000, batch_size=100, verbose=2)
         if train:
-            estimator.fit(X, Y)
+            FitDataset(estimator, dataset, augment=augment)
             estimator.model.save("Con4_Flat_Recent.h5")
+            export_model(estimator.model, "Con4_Flat_Recent.npz")
         else:
             estimator.model = load_model('Con4_Flat_Recent.h5')#load_model('Con4_Flat_Best.h5')
         return estimator
     elif model_type == 1:
         estimator = KerasRegressor(build_fn=baseline_model, epochs=300, batch_size=100, verbose=2)   
         if train:
-            estimator.fit(boards, Y)
+            FitDataset(estimator, dataset, board_shape=(6, 7, 1), augment=augment)
             estimator.model.save("Con4_Conv_Recent.h5")
+            export_model(estimator.model, "Con4_Conv_Recent.npz")
         else:
             estimator.model = load_model('Con4_Conv_Recent.h5')
         return estimator
     return None
         
 
-def init_model_villainous():
+def init_model_villainous(data='game.txt'):
     global model, estimator
-    dataset = loadtxt('game.txt', delimiter=',')
-    X = dataset[:,0:460]
-    Y = dataset[:,460]
+    from keras.models import Sequential
+    from keras.layers import Dense
+    from keras.wrappers.scikit_learn import KerasRegressor
+    # 460 features, then the value
+    dataset = open_dataset(data, 460)
 
     def baseline_model():
         # create model
@@ -277,161 +494,214 @@ def init_model_villainous():
         return model
     # evaluate model
     estimator = KerasRegressor(build_fn=baseline_model, epochs=400, batch_size=50, verbose=2)
-    print(f"Type of x: {type(X)}, Y: {type(Y)}")
-    estimator.fit(X, Y)
+    FitDataset(estimator, dataset)
     estimator.model.save("TheModel")
-    #estimator.fit(X[0:1,:], Y[0:1], epochs=1, batch_size=1)
+    export_model(estimator.model, "TheModel.npz")
     return
-    kfold = KFold(n_splits=10)
-    results = cross_val_score(estimator, X, Y, cv=kfold)
-    print("Baseline: %.2f (%.2f) MSE" % (results.mean(), results.std()))
-    estimator.fit(X, Y)
-    
-    return
-
-
-records = []
-data = []
-data_x = []
-data_y = []
-def record(state, result, player):
-    global records, data, estimator
-    records.append((state, result))
-    
-    entry = state.to_inputs(player)
-    data_x.append(entry)
-    data_y.append(result)    
-    
-    #estimator.fit(np.array([entry]), np.array([result]), epochs=1, batch_size=1)
 
-    entry = deepcopy(entry)
-    entry.append(result)
-    data.append(entry)
-    
 
-def ISMCTS(rootstate, itermax, verbose = False, rollout_agent=None):
+def ISMCTS(rootstate, itermax, verbose = False, rollout_agent=None, backend="object", workers=1, pool=None, time_budget_ms=None, min_iterations=1, rootnode=None, in_place=False, recorder=None, rollout_moves=None):
     """ Conduct an ISMCTS search for itermax iterations starting from rootstate.
         Return the best move from the rootstate.
+        backend selects how the tree is stored, see MakeRootNode().
+        With workers > 1 the iterations are split over independent searches in a process pool
+        (see ParallelISMCTS), reusing pool if one is given.
+        With time_budget_ms the search stops once the budget is spent (after at least min_iterations),
+        and itermax may be None to search for the whole budget. See SearchBudget.
+        rootnode continues an earlier search from one of its detached nodes (ignored when workers > 1).
+        in_place determinizes and unwinds a single copy of rootstate instead of cloning it every iteration,
+        for states implementing Randomize/DoUndoableMove/UndoMove. See ISMCTSIterations. Recording each move
+        for UndoMove costs more than the one Clone() per iteration of the games here, so for them it is the
+        slower path; it only pays off for states that are expensive to clone.
+        rollout_moves caps the moves of each rollout; a rollout stopped by it scores as a draw. Without it
+        rollouts of games that need not end (e.g. CaptainHook against CaptainHook) can run forever.
+        With a recorder (a dataset.SampleWriter), the position after each well-explored root move is
+        recorded with its win rate, as training data for a value model.
     """
 
-    rootnode = Node()
+    if workers > 1:
+        rootnode = ParallelISMCTS(rootstate, itermax, workers, rollout_agent=rollout_agent, backend=backend, pool=pool,
+                                  time_budget_ms=time_budget_ms, min_iterations=min_iterations, in_place=in_place, rollout_moves=rollout_moves)
+    else:
+        if rootnode is None:
+            rootnode = MakeRootNode(backend)
+        ISMCTSIterations(rootnode, rootstate, itermax, rollout_agent=rollout_agent, time_budget_ms=time_budget_ms,
+                         min_iterations=min_iterations, in_place=in_place, rollout_moves=rollout_moves)
+
+    # Output some information about the tree - can be omitted
+    if (verbose): print(rootnode.TreeToString(0))
+    else: print(rootnode.ChildrenToString())
+    
+    if recorder is not None:
+        for node in rootnode.childNodes:
+            if node.visits >= 10:
+                potential_state = rootstate.Clone()#
+                if node.move in potential_state.GetMoves():
+                    potential_state.DoMove(node.move)
+                    recorder.add_state(potential_state, node.playerJustMoved, node.wins / node.visits)
+
+
+    # A reused tree can hold children for moves that turned out not to be legal here (e.g. cards we didn't draw)
+    legalChildren = rootnode.GetLegalChildren(rootstate.GetMoves())
+    total_visits = 0
+    for node in legalChildren:
+        total_visits += node.visits
+    for node in legalChildren:
+        node.target_prob = node.visits / total_visits if total_visits > 0 else 0
+        #if node.target_prob > 0 :
+            #print(f"prob: {node.target_prob}")
+
+    best_node = max(legalChildren, key = lambda c: c.visits)
+    return best_node.move, best_node # return the move that was most visited
+
+def ISMCTSIterations(rootnode, rootstate, itermax, rollout_agent=None, time_budget_ms=None, min_iterations=1, in_place=False, rollout_moves=None):
+    """ Run ISMCTS iterations from rootstate until the SearchBudget is exhausted, growing the tree below rootnode.
+        With in_place the state is cloned once and each iteration re-randomizes it with Randomize(),
+        then takes its moves back with UndoMove() instead of starting from a fresh CloneAndRandomize().
+        Rollouts stop after rollout_moves moves, if given, and are then backpropagated as draws.
+    """
     #rollout_agent = RegressionAgent(estimator)
+    budget = SearchBudget(itermax, time_budget_ms, min_iterations)
+    if in_place:
+        state = rootstate.Clone()
+    undo = []
+
+    def play(move):
+        if in_place:
+            undo.append(state.DoUndoableMove(move))
+        else:
+            state.DoMove(move)
 
-    for i in range(itermax):
+    i = 0
+    while not budget.Exhausted(i):
+        i += 1
         node = rootnode
         
         # Determinize
-        state = rootstate.CloneAndRandomize(rootstate.playerToMove)
+        if in_place:
+            state.Randomize(rootstate.playerToMove)
+        else:
+            state = rootstate.CloneAndRandomize(rootstate.playerToMove)
 
         # Select
         moves = state.GetMoves()
-        while moves != [] and node.GetUntriedMoves(moves) == []: # node is fully expanded and non-terminal
-            node = node.UCBSelectChild(state.GetMoves())
-            state.DoMove(node.move)
+        untriedMove = node.GetUntriedMove(moves)
+        while moves != [] and untriedMove is None: # node is fully expanded and non-terminal
+            node = node.UCBSelectChild(moves)
+            play(node.move)
             moves = state.GetMoves()
+            untriedMove = node.GetUntriedMove(moves)
 
         # Expand
-        untriedMoves = node.GetUntriedMoves(moves) # state.GetMoves()
-        if untriedMoves != []: # if we can expand (i.e. state/node is non-terminal)
+        if untriedMove is not None: # if we can expand (i.e. state/node is non-terminal)
             if rollout_agent:
-                m = rollout_agent.GetMove(state, moves=untriedMoves)
+                m = rollout_agent.GetMove(state, moves=node.GetUntriedMoves(moves))
             else:
-                m = random.choice(untriedMoves) 
+                m = untriedMove
             player = state.playerToMove
-            state.DoMove(m)
+            play(m)
             node = node.AddChild(m, player) # add child and descend tree
 
         # Simulate
-        
-        moves = state.GetMoves()
-        move_time = 0
-        while moves != []: # while state is non-terminal
-            if rollout_agent:
-                move = rollout_agent.GetMove(state, moves=moves)
-                state.DoMove(move)                
-            else:
-                state.DoMove(random.choice(moves))
+        finished = True
+        if rollout_agent:
+            played = 0
             moves = state.GetMoves()
+            while moves != []: # while state is non-terminal
+                if played == rollout_moves:
+                    finished = False
+                    break
+                play(rollout_agent.GetMove(state, moves=moves))
+                played += 1
+                moves = state.GetMoves()
+        elif in_place:
+            played = 0
+            move = state.GetRandomMove()
+            while move is not None:
+                if played == rollout_moves:
+                    finished = False
+                    break
+                play(move)
+                played += 1
+                move = state.GetRandomMove()
+        else:
+            finished = state.DoRandomRollout(rollout_moves)
+        result = state if finished else UnfinishedRollout()
 
         # Backpropagate
         while node != None: # backpropagate from the expanded node and work back to the root node
-            node.Update(state)
+            node.Update(result)
             node = node.parentNode
 
-    # Output some information about the tree - can be omitted
-    if (verbose): print(rootnode.TreeToString(0))
-    else: print(rootnode.ChildrenToString())
-    
-    if True:
-        for node in rootnode.childNodes:
-            if node.visits >= 10:
-                potential_state = rootstate.Clone()#
-                if node.move in potential_state.GetMoves():
-                    potential_state.DoMove(node.move)
-                    record(potential_state, node.wins / node.visits, node.playerJustMoved)
-
-
-    total_visits = 0
-    for node in rootnode.childNodes:
-        total_visits += node.visits
-    for node in rootnode.childNodes:
-        node.target_prob = node.visits / total_visits
-        #if node.target_prob > 0 :
-            #print(f"prob: {node.target_prob}")
+        # Unwind the determinization back to the root
+        while undo:
+            state.UndoMove(undo.pop())
 
-    best_node = max(rootnode.childNodes, key = lambda c: c.visits)
-    return best_node.move, best_node # return the move that was most visited
+def _ISMCTSWorker(job):
+    """ Run one independent search for ParallelISMCTS and return its root children statistics.
+    """
+    rootstate, itermax, rollout_agent, backend, seed, time_budget_ms, min_iterations, in_place, rollout_moves = job
+    random.seed(seed)
+    np.random.seed(seed)
+    rootnode = MakeRootNode(backend)
+    ISMCTSIterations(rootnode, rootstate, itermax, rollout_agent=rollout_agent, time_budget_ms=time_budget_ms,
+                     min_iterations=min_iterations, in_place=in_place, rollout_moves=rollout_moves)
+    return [(child.move, child.playerJustMoved, child.wins, child.visits, child.avails) for child in rootnode.childNodes]
+
+def ParallelISMCTS(rootstate, itermax, workers, rollout_agent=None, backend="object", pool=None, time_budget_ms=None, min_iterations=1, in_place=False,
+                   rollout_moves=None):
+    """ Root-parallel ISMCTS: split itermax iterations over independent, differently seeded searches
+        in a pool of worker processes, then merge the children of their roots by move key.
+        Return a root Node holding the merged statistics.
+        rootstate (and rollout_agent) are pickled to the workers. Each worker gets the whole time budget.
+    """
+    jobs = []
+    for i in range(workers):
+        if itermax is None:
+            iterations = None
+        else:
+            iterations = itermax // workers + (1 if i < itermax % workers else 0)
+            # The first worker always searches, at least SearchBudget's one iteration
+            if iterations == 0 and i > 0:
+                continue
+        jobs.append((rootstate, iterations, rollout_agent, backend, random.getrandbits(32), time_budget_ms, max(1, -(-min_iterations // workers)), in_place,
+                     rollout_moves))
+
+    if pool is None:
+        with Pool(workers) as pool:
+            results = pool.map(_ISMCTSWorker, jobs)
+    else:
+        results = pool.map(_ISMCTSWorker, jobs)
 
-def AlphaMCTS(rootstate, itermax, verbose = False, model=None):
+    rootnode = Node()
+    for children in results:
+        for move, player, wins, visits, avails in children:
+            child = rootnode.childIndex.get(MoveKey(move))
+            if child is None:
+                child = rootnode.AddChild(move, player)
+                child.avails = 0
+            child.wins += wins
+            child.visits += visits
+            child.avails += avails
+            rootnode.visits += visits
+    return rootnode
+
+def AlphaMCTS(rootstate, itermax, verbose = False, model=None, backend="object", batch_size=1, virtual_loss=1, time_budget_ms=None, min_iterations=1, table=None):
     """ Conduct an ISMCTS search for itermax iterations starting from rootstate.
         Return the best move from the rootstate.
+        backend selects how the tree is stored, see MakeRootNode().
+        Up to batch_size leaves are selected per round (with virtual_loss discouraging repeated paths)
+        and evaluated together in a single model call, see AlphaMCTSIterations().
+        time_budget_ms and min_iterations work as for ISMCTS.
+        With a TranspositionTable, evaluations are kept by position hash and reused for positions
+        reached again, by this search or a later one sharing the table.
         https://www.reddit.com/r/reinforcementlearning/comments/cc5mv4/how_to_incorporate_neural_networks_into_a_mcts/
         https://matthewdeakos.me/2018/07/03/integrating-monte-carlo-tree-search-and-neural-networks/
     """
     
-    rootnode = Node()
-
-    for i in range(itermax):
-        node = rootnode
-        
-        # Determinize
-        state = rootstate.CloneAndRandomize(rootstate.playerToMove)
-        player = state.playerToMove
-        # Select
-        moves = state.GetMoves()
-        while moves != [] and node.GetUntriedMoves(moves) == [] and node.nn_value > 0: # node is fully expanded and non-terminal
-            node = node.NNSelectChild(state.GetMoves())
-            state.DoMove(node.move)
-            moves = state.GetMoves()
-        
-        # The steps 2 and 3 are replaced by a policy and value network: 
-        # we expand all the child nodes with probability priors given by the network, 
-        # and instead of simulating the whole game onwards, simply use the value output. 
-        # To increase exploration in self play, instead of selecting the most visited move,
-        # you can select it with some temperature on a soft max you sample.
-        
-        untriedMoves = node.GetUntriedMoves(moves)
-        if untriedMoves != []:
-            value, prob_priors = state.predict(model, node.playerJustMoved, use_boards=True)
-            node.nn_value = value
-            for i in range(0, len(moves)):
-                move = moves[i]
-                if move in untriedMoves:
-                    child = node.AddChild(move, state.GetNextPlayer(state.playerToMove))
-                    #print(f"setting a prior to {prob_priors[i]}")
-                    child.nn_pred_prob = prob_priors[i]
-        leaf = node
-        # Backpropagate
-        while node != None: # backpropagate from the expanded node and work back to the root node
-            node.visits += 1
-            
-            # If the player that owns node is the same player that owns the leaf node, then we add v to w. Otherwise, we subtract v from w.
-            node.nn_w += leaf.nn_value * (-1 if leaf.playerJustMoved != node.playerJustMoved else 1)
-            
-            # We update the action-value q to w/visits.
-            node.nn_q = node.nn_w / node.visits
-            
-            node = node.parentNode
+    rootnode = MakeRootNode(backend)
+    AlphaMCTSIterations(rootnode, rootstate, itermax, model, batch_size=batch_size, virtual_loss=virtual_loss,
+                        time_budget_ms=time_budget_ms, min_iterations=min_iterations, table=table)
 
     # Output some information about the tree - can be omitted
     if (verbose): print(rootnode.TreeToString(0))
@@ -447,13 +717,156 @@ def AlphaMCTS(rootstate, itermax, verbose = False, model=None):
         else:
             node.target_prob = 0
     
-    best_node = max(rootnode.childNodes, key = lambda c: c.target_prob) 
+    # After a single iteration no child has been visited yet, so the priors decide
+    best_node = max(rootnode.childNodes, key = lambda c: (c.target_prob, c.nn_pred_prob))
     return best_node.move, best_node # return the move that was most visited
 
+def PredictBatch(model, states, players):
+    """ Evaluate each state from the viewpoint of the matching player, returning (values, priors).
+        Uses a single model call when the state class provides predict_batch(), else calls predict() per state.
+    """
+    state_class = type(states[0])
+    if hasattr(state_class, "predict_batch"):
+        return state_class.predict_batch(model, states, players, use_boards=True)
+    predictions = [state.predict(model, player, use_boards=True) for state, player in zip(states, players)]
+    return [value for value, priors in predictions], [priors for value, priors in predictions]
+
+def CachedPredictBatch(model, states, players, table=None):
+    """ PredictBatch() through a TranspositionTable: only the positions not found in table are evaluated,
+        and their evaluations are stored in it. States whose Hash() is None are always evaluated.
+        Evaluations are kept by CanonicalHash(), with the priors of mirrored positions stored mirrored,
+        so a position and its mirror image (in this batch or in the table) are evaluated once.
+    """
+    if table is None:
+        return PredictBatch(model, states, players)
+    keys = []
+    mirrored = []
+    for state, player in zip(states, players):
+        position, mirror = state.CanonicalHash()
+        keys.append(None if position is None else (position, player))
+        mirrored.append(mirror)
+    evaluations = [None if key is None else table.get(key) for key in keys]
+    # Positions to evaluate: the first state of each key missing from the table, and every state without a key
+    missing = {}
+    for i, evaluation in enumerate(evaluations):
+        if evaluation is None:
+            missing.setdefault(i if keys[i] is None else keys[i], i)
+    if missing:
+        evaluate = list(missing.values())
+        values, priors = PredictBatch(model, [states[i] for i in evaluate], [players[i] for i in evaluate])
+        for key, i, value, prob_priors in zip(missing, evaluate, values, priors):
+            missing[key] = (value, states[i].MirrorPolicy(prob_priors) if mirrored[i] else prob_priors)
+            if keys[i] is not None:
+                table.put(key, missing[key])
+    results = []
+    for i, evaluation in enumerate(evaluations):
+        if evaluation is None:
+            evaluation = missing[i if keys[i] is None else keys[i]]
+        value, prob_priors = evaluation
+        results.append((value, states[i].MirrorPolicy(prob_priors) if mirrored[i] else prob_priors))
+    return [value for value, priors in results], [priors for value, priors in results]
+
+def AddVirtualLoss(node, virtual_loss):
+    """ Count a pending visit on node and its ancestors, and make them look worse until it is backed up.
+    """
+    while node != None:
+        node.visits += 1
+        node.nn_w -= virtual_loss
+        node.nn_q = node.nn_w / node.visits
+        node = node.parentNode
+
+def AlphaMCTSIterations(rootnode, rootstate, itermax, model, batch_size=1, virtual_loss=1, time_budget_ms=None, min_iterations=1, table=None):
+    """ Run AlphaMCTS iterations from rootstate until the SearchBudget is exhausted, growing the tree below rootnode.
+        Each round descends up to batch_size times, adding virtual loss along every selected path,
+        evaluates all new leaves with one PredictBatch() call and then backs up the results.
+        A round ends early when a descent reaches a leaf already waiting for evaluation.
+        The time budget is checked between rounds.
+        Leaves whose position is in table (keyed by state hash and player) skip the model call.
+    """
+    budget = SearchBudget(itermax, time_budget_ms, min_iterations)
+    iterations = 0
+    while not budget.Exhausted(iterations):
+        leaves = []
+        pending = {} # leaf node -> (state, moves, untriedMoves) still to be evaluated this round
+        
+        while (budget.itermax is None or iterations < budget.itermax) and len(leaves) < batch_size:
+            node = rootnode
+            
+            # Determinize
+            state = rootstate.CloneAndRandomize(rootstate.playerToMove)
+            # Select
+            moves = state.GetMoves()
+            while moves != [] and node.GetUntriedMove(moves) is None and node.nn_value > 0: # node is fully expanded and non-terminal
+                node = node.NNSelectChild(moves)
+                state.DoMove(node.move)
+                moves = state.GetMoves()
+            
+            if node in pending:
+                break
+            
+            untriedMoves = node.GetUntriedMoves(moves)
+            if untriedMoves != []:
+                pending[node] = (state, moves, untriedMoves)
+            AddVirtualLoss(node, virtual_loss)
+            leaves.append(node)
+            iterations += 1
+        
+        # The steps 2 and 3 are replaced by a policy and value network: 
+        # we expand all the child nodes with probability priors given by the network, 
+        # and instead of simulating the whole game onwards, simply use the value output. 
+        # To increase exploration in self play, instead of selecting the most visited move,
+        # you can select it with some temperature on a soft max you sample.
+        
+        if len(pending) > 0:
+            nodes = list(pending)
+            values, priors = CachedPredictBatch(model, [pending[node][0] for node in nodes], [node.playerJustMoved for node in nodes], table)
+            for node, value, prob_priors in zip(nodes, values, priors):
+                state, moves, untriedMoves = pending[node]
+                node.nn_value = value
+                untriedKeys = {MoveKey(move) for move in untriedMoves}
+                for i in range(0, len(moves)):
+                    move = moves[i]
+                    key = MoveKey(move)
+                    if key in untriedKeys:
+                        untriedKeys.discard(key)
+                        child = node.AddChild(move, state.GetNextPlayer(state.playerToMove))
+                        #print(f"setting a prior to {prob_priors[i]}")
+                        child.nn_pred_prob = prob_priors[i]
+        
+        for leaf in leaves:
+            node = leaf
+            # Backpropagate (the visit itself was already counted by the virtual loss)
+            while node != None: # backpropagate from the expanded node and work back to the root node
+                # If the player that owns node is the same player that owns the leaf node, then we add v to w. Otherwise, we subtract v from w.
+                node.nn_w += virtual_loss + leaf.nn_value * (-1 if leaf.playerJustMoved != node.playerJustMoved else 1)
+                
+                # We update the action-value q to w/visits.
+                node.nn_q = node.nn_w / node.visits
+                
+                node = node.parentNode
+
+def ObserveMove(agents, state, move):
+    """ Tell every distinct agent that keeps state between moves (e.g. ISMCTSAgent reusing its tree)
+        that move was just made in state.
+    """
+    for agent in {id(agent): agent for agent in agents}.values():
+        if hasattr(agent, "ObserveMove"):
+            agent.ObserveMove(state, move)
+
+def CheckCloneMove(state, move):
+    """ Do move on state and on a clone of it, and raise a RuntimeError if the two reach different positions
+        (by Hash()). Searches play their moves on clones, so a clone must stay in step with the game.
+    """
+    clone = state.Clone()
+    clone.DoMove(move)
+    state.DoMove(move)
+    if clone.Hash() != state.Hash():
+        raise RuntimeError(f"A clone of the state reached a different position after {move}")
+
 def PlayGame(agents, game_state):
     """ Play a sample game between two ISMCTS players.
     """
-    global model, estimator, data_x, data_y, data, records
+    global model, estimator
     from agents import ISMCTSAgent
 
     #tf.keras.backend.set_learning_phase(0)
@@ -492,6 +905,7 @@ def PlayGame(agents, game_state):
                 #print(f"\nRandom Move: {m}\n")
 
         state.DoMove(m)
+        ObserveMove(agents, state, m)
         first_move_ever = False
         for i in range(0, state.numberOfPlayers):
             if state.GetResult(i) == 1:
@@ -514,86 +928,61 @@ def PlayGame(agents, game_state):
     if not someoneWon:
         print("Nobody wins!")
     
-    #save_records = True
-    #if save_records:
-    #f = open("game.txt", "a")
-    print(f"Records taken: {len(records)}")
-    if len(data_x) > 0:
-        print(f"Input length: {len(data_x[0])}")
-    index = 0
-    for entry in data_x:
-        str_list = [str(element) for element in entry]
-        list_str = ",".join(str_list)
-        list_str += f",{data_y[index]}\n"
-        #f.write(list_str)
-        index += 1
-    #f.close()
-    data_x.clear()
-    data_y.clear()
-    records.clear()
-    data.clear()
     #if estimator:
         #estimator.model.save("TheModel")
     
     return winner
 
-def SelfPlayGame(agents, game_state):
-    player_moves = []
-    for agent in agents:
-        player_moves.append([])
+def PlayConcurrentGames(make_agents, make_state, games, threads):
+    """ Play games SelfPlayGames at once on a pool of threads and return the winners in order.
+        make_agents() and make_state() are called once per game; agents that share an
+        InferenceServer get their evaluations batched together across all running games.
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        return list(executor.map(lambda i: SelfPlayGame(make_agents(), make_state()), range(games)))
+
+def SelfPlayGame(agents, game_state, recorder=None, policy_size=7, verbose=True):
+    """ Play game_state out between agents and return the winner (None for a draw).
+        With a recorder (such as a dataset.SampleWriter), every position a searching agent moved from is recorded
+        from the mover's viewpoint once the game is over: the final result (1 win, -1 loss, 0 draw) is its value and
+        the visit counts of the search its policy, indexed by move (policy_size is 7 for the columns of Connect Four).
+    """
+    # (player, features, policy) of each searched position, until the result is known
+    samples = []
     state = game_state
     game_over = False
     prev_turn = 0
     while not game_over and state.GetMoves() != []:
-        if prev_turn != state.playerToMove:
-            print(f"============ Player {state.playerToMove}'s Turn ===========")
-        prev_turn = state.playerToMove  
-        print(str(state))
+        if verbose:
+            if prev_turn != state.playerToMove:
+                print(f"============ Player {state.playerToMove}'s Turn ===========")
+            print(str(state))
+        prev_turn = state.playerToMove
         
-        agent = agents[state.playerToMove]
         m, node = agents[state.playerToMove].GetMove(state)
-        if node:
-            player_moves[state.playerToMove].append((node, state.Clone()))
+        if node and recorder is not None:
+            target_policy = np.zeros(policy_size, dtype=np.float32)
+            for n in node.parentNode.childNodes:
+                target_policy[n.move] = n.target_prob
+            samples.append((state.playerToMove, state_features(state, state.playerToMove), target_policy))
 
         state.DoMove(m)
+        ObserveMove(agents, state, m)
         for i in range(0, state.numberOfPlayers):
             if state.GetResult(i) == 1:
                 game_over = True
                 break
-   
-    someoneWon = False
     
     winner = None
     for p in range(0, state.numberOfPlayers):
         if state.GetResult(p) > 0:
-            print("Player " + str(p) + " wins!")
             winner = p
-            someoneWon = True
-    if not someoneWon:
-        print("Nobody wins!")
-    return winner
-    data = []
-    
-    f = open("game.txt", "a")
-    
-    for p in range(0, state.numberOfPlayers):
-        for node, state in player_moves[p]:
-            
-            node.target_value = 1 if winner == p else (-1 if winner is not None else 0)          
-            target_policy = [0] * 7
-            for n in node.parentNode.childNodes:
-                target_policy[n.move] = n.target_prob
-
-            
-            data.append((state, node.target_value, target_policy))
-            inputs = state.to_inputs(p)
-            inputs.append(node.target_value)
-            inputs.extend(target_policy)
-            
-            str_list = [str(element) for element in inputs]
-            list_str = ",".join(str_list) + "\n"
-            f.write(list_str)
-    f.close()
+    if verbose:
+        print("Nobody wins!" if winner is None else "Player " + str(winner) + " wins!")
+    if recorder is not None:
+        for p, features, target_policy in samples:
+            target_value = 1 if winner == p else (-1 if winner is not None else 0)
+            recorder.add(features, target_value, target_policy)
     return winner
     
 if __name__ == "__main__":
@@ -1,10 +1,168 @@
-import collections
+from collections import Counter
 from collections.abc import Iterable
+from math import comb
+
+def card_keys(cards):
+    """ Canonical key for a multiset of cards, independent of their order. """
+    return tuple(sorted(card.key() for card in cards))
+
+def board_card_key(card):
+    """ Key of a card on the board: its own key and the keys of the items equipped to it.
+        Two cards in a zone with the same board key are interchangeable. """
+    return (card.key(), card_keys(card.items))
+
+class Subsets:
+    """ The subsets of items with at least min_size elements, as tuples in the order of
+        game.powerset(items), but built only when indexed: subset k is unranked from k directly.
+    """
+
+    def __init__(self, items, min_size=0):
+        self.items = list(items)
+        self.min_size = min_size
+        self.counts = None # how many items there are with each key, for membership tests
+        n = len(self.items)
+        self.length = sum(comb(n, size) for size in range(min_size, n + 1))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("subset index out of range")
+        n = len(self.items)
+        # Smaller subsets come first
+        size = self.min_size
+        while index >= comb(n, size):
+            index -= comb(n, size)
+            size += 1
+        # Then in the lexicographic order of itertools.combinations
+        subset = []
+        start = 0
+        for remaining in range(size, 0, -1):
+            i = start
+            while index >= comb(n - i - 1, remaining - 1):
+                index -= comb(n - i - 1, remaining - 1)
+                i += 1
+            subset.append(self.items[i])
+            start = i + 1
+        return tuple(subset)
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+    def __contains__(self, subset):
+        """ Whether one of the subsets holds the same items as subset, compared by key() as in card_keys.
+        """
+        if not self.min_size <= len(subset) <= len(self.items):
+            return False
+        if self.counts is None:
+            self.counts = Counter(item.key() for item in self.items)
+        if len(subset) == 1:
+            return subset[0].key() in self.counts
+        for key, count in Counter(item.key() for item in subset).items():
+            if self.counts[key] < count:
+                return False
+        return True
+
+class MoveList:
+    """ A sequence of moves where some runs of moves are only built when they are indexed.
+        A lazy run is a sequence (such as Subsets) and a function that turns one of its elements into a move,
+        so the list can be counted, indexed and sampled from without building the moves it does not return.
+    """
+
+    def __init__(self, moves=()):
+        self.segments = [] # (sequence, make_move, element_of), make_move is None for moves that are already built
+        self.length = 0
+        self.built = None # the set of the built moves, made by the first membership test
+        self.extend(moves)
+
+    def append(self, move):
+        if not self.segments or self.segments[-1][1] is not None:
+            self.segments.append(([], None, None))
+        self.segments[-1][0].append(move)
+        self.length += 1
+        self.built = None
+
+    def extend(self, moves):
+        for move in moves:
+            self.append(move)
+
+    def extend_lazy(self, sequence, make_move, element_of=None):
+        """ Add a move for each element of sequence, made by make_move(element) when it is needed.
+            element_of(move) returns the element a move equal to move would be made from, or None when
+            make_move makes no such move, so that testing whether a move is in the list doesn't build them.
+        """
+        if len(sequence) > 0:
+            self.segments.append((sequence, make_move, element_of))
+            self.length += len(sequence)
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("move index out of range")
+        for sequence, make_move, element_of in self.segments:
+            if index < len(sequence):
+                return sequence[index] if make_move is None else make_move(sequence[index])
+            index -= len(sequence)
+
+    def __iter__(self):
+        for sequence, make_move, element_of in self.segments:
+            if make_move is None:
+                yield from sequence
+            else:
+                for element in sequence:
+                    yield make_move(element)
+
+    def __contains__(self, move):
+        if self.built is None:
+            self.built = {built for sequence, make_move, element_of in self.segments if make_move is None for built in sequence}
+        if move in self.built:
+            return True
+        for sequence, make_move, element_of in self.segments:
+            if make_move is None:
+                continue
+            if element_of is None:
+                if any(make_move(element) == move for element in sequence):
+                    return True
+            else:
+                element = element_of(move)
+                if element is not None and element in sequence:
+                    return True
+        return False
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
 
 class Move:
     
+    # Whether performing the move can decide the game, see VillainousState.UpdateResults
+    can_change_result = True
+    # Whether performing the move can change the zones of the board, or players other than the one moving,
+    # so that VillainousState.DoUndoableMove only records what the move can change
+    changes_board = True
+    changes_others = True
+    
     def __init__(self, parent_action):
         self.parent_action = parent_action
+        self._key = None
 
     def perform(self, game_state, player):
         pass
@@ -12,14 +170,32 @@ class Move:
     def __str__(self):
         return self.__class__.__name__
 
+    def key(self):
+        """ Return a hashable key that is equal for two moves exactly when the moves are equal.
+            Moves are compared and hashed through their key, which is computed once and cached.
+        """
+        if self._key is None:
+            self._key = self.make_key()
+        return self._key
+
+    def make_key(self):
+        return (type(self).__name__, type(self.parent_action).__name__)
+
     def __eq__(self, other):
-        return type(self) is type(other) and type(self.parent_action) is type(other.parent_action)
+        return isinstance(other, Move) and self.key() == other.key()
     
     def __ne__(self, other):
-        return type(self) is not type(other) or type(self.parent_action) is not type(other.parent_action)
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key())
 
 class EndTurnMove(Move):
     
+    can_change_result = False
+    changes_board = False
+    changes_others = False
+    
     def __init__(self):
         super().__init__(None)
     
@@ -31,6 +207,11 @@ class EndTurnMove(Move):
 
 class MoveZoneMove(Move):
 
+    # The zone's power is only collected after perform(), so DoMove updates the results itself
+    can_change_result = False
+    changes_board = False
+    changes_others = False
+
     def __init__(self, zone):
         super().__init__(None)
         self.zone = zone
@@ -41,19 +222,25 @@ class MoveZoneMove(Move):
     def __str__(self):
         return f"Move to zone {self.zone.number}"
         
-    def __eq__(self, other):
-        return type(self) is type(other) and self.zone == other.zone
-    
-    def __ne__(self, other):
-        return type(self) is not type(other) or self.zone.number != other.zone.number
+    def make_key(self):
+        return (type(self).__name__, self.zone.number)
 
 class PlayCardMove(Move):
 
+    # Card effects are played on the moving player
+    changes_others = False
+
     def __init__(self, card, parent_action, zone=None, target=None):
         super().__init__(parent_action)
         self.card = card
         self.zone = zone
         self.target = target
+        # A card on the board is found again by its position in the zone, see BoardZone.get_card
+        if zone is not None and target is not None:
+            self.target_key = board_card_key(target)
+            self.target_position = zone.position_of(target)
+        else:
+            self.target_key = self.target_position = None
     
     def perform(self, game_state, player):
         from game import CardType
@@ -68,8 +255,20 @@ class PlayCardMove(Move):
                 #print(f"In hand: {card}")
             player.hand.remove(self.card)
             player.power -= self.card.cost
-        self.card.play(player, game_state, target=self.target, zone=player.board[self.zone.number] if self.zone else None)
+        zone = player.board[self.zone.number] if self.zone else None
+        target = self.target
+        if zone is not None and target is not None:
+            target = zone.get_card(self.target_key, self.target_position)
+        self.card.play(player, game_state, target=target, zone=zone)
         
+    def target_subset(self, card):
+        """ The cards this move targets if it plays card at a set of cards (as sacrifice does), or None.
+            Lets MoveList find it among the subsets it has not built.
+        """
+        if self.zone is None and isinstance(self.target, Iterable) and self.card.key() == card.key():
+            return self.target
+        return None
+
     def __str__(self):
         if self.zone and not self.target:
             return f"Play {self.card.name} to zone {self.zone.number}"
@@ -77,19 +276,21 @@ class PlayCardMove(Move):
             return f"Equip {self.card.name} to {self.target.name}"
         return f"Play card {self.card.name}"
                 
-    def __eq__(self, other):
-        if type(self) is type(other) and self.card == other.card and self.zone == other.zone and self.target == other.target:
-            if isinstance(self.target, Iterable) and isinstance(other.target, Iterable):
-                return collections.Counter(self.target) == collections.Counter(other.target)
-            else:
-                return True
-        return False
-    
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def make_key(self):
+        if isinstance(self.target, Iterable):
+            target = card_keys(self.target)
+        elif self.target_key is not None:
+            target = self.target_key
+        else:
+            target = self.target.key() if self.target is not None else None
+        return (type(self).__name__, self.card.key(), self.zone.number if self.zone else None, target)
         
 class DiscardCardsMove(Move):
     
+    can_change_result = False
+    changes_board = False
+    changes_others = False
+    
     def __init__(self, cards, parent_action):
         super().__init__(parent_action)
         self.cards = cards
@@ -101,75 +302,83 @@ class DiscardCardsMove(Move):
     def __str__(self):
         return f"Discard {len(self.cards)} cards"
     
-    def __eq__(self, other):
-        if type(self) is type(other):
-            return collections.Counter(self.cards) == collections.Counter(other.cards)
-                  
-        return False
-        
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def make_key(self):
+        return (type(self).__name__, card_keys(self.cards))
 
 class MoveAllyMove(Move):
     
+    changes_others = False
+
     def __init__(self, ally, prev_zone, zone, parent_action):
         super().__init__(parent_action)
         self.ally = ally
+        self.ally_key = board_card_key(ally)
+        self.position = prev_zone.position_of(ally)
         self.prev_zone = prev_zone.number
         self.zone = zone.number
     
     def perform(self, game_state, player):
         from game import CardType
-        if self.ally.card_type == CardType.ALLY:
-            player.board[self.prev_zone].allies.remove(self.ally)
-            player.board[self.zone].allies.append(self.ally)
-        elif self.ally.card_type == CardType.ITEM:
-            player.board[self.prev_zone].items.remove(self.ally)
-            player.board[self.zone].items.append(self.ally)
-        elif self.ally.card_type == CardType.HERO:
-            player.board[self.prev_zone].heroes.remove(self.ally)
-            player.board[self.zone].heroes.append(self.ally)
-        self.ally.current_zone = self.zone
+        ally = player.board[self.prev_zone].get_card(self.ally_key, self.position)
+        if ally.card_type == CardType.ALLY:
+            player.board[self.prev_zone].remove_card(ally)
+            player.board[self.zone].allies.append(ally)
+        elif ally.card_type == CardType.ITEM:
+            player.board[self.prev_zone].remove_card(ally)
+            player.board[self.zone].items.append(ally)
+        elif ally.card_type == CardType.HERO:
+            player.board[self.prev_zone].remove_card(ally)
+            player.board[self.zone].heroes.append(ally)
+        ally.current_zone = self.zone
         
     def __str__(self):
         return f"Move {self.ally.name} to zone {self.zone}"    
         
-    def __eq__(self, other):
-        return type(self) is type(other) and self.ally == other.ally and self.prev_zone == other.prev_zone and self.zone == other.zone
-        
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def make_key(self):
+        return (type(self).__name__, self.ally_key, self.prev_zone, self.zone)
 
 class VanquishMove(Move):
 
+    changes_others = False
+
     def __init__(self, allies, hero, zone, parent_action):
         super().__init__(parent_action)
         self.allies = allies
         self.hero = hero
         self.zone = zone.number        
+        self.ally_keys = [board_card_key(ally) for ally in allies]
+        self.ally_positions = [zone.position_of(ally) for ally in allies]
+        self.hero_key = board_card_key(hero)
+        self.hero_position = zone.position_of(hero)
 
     def perform(self, game_state, player):
         from game import PowerAction
 
-        for ally in self.allies:
-            player.board[self.zone].allies.remove(ally)     
+        zone = player.board[self.zone]
+        # Find every card before removing any, as removing them moves the others
+        hero = zone.get_card(self.hero_key, self.hero_position)
+        allies = []
+        for key, position in zip(self.ally_keys, self.ally_positions):
+            allies.append(zone.get_card(key, position, taken=allies))
+        for ally in allies:
+            zone.remove_card(ally)
             player.deck_discard.append(ally)
             for item in ally.items:
                 player.deck_discard.append(item)
             ally.items = []
-        player.board[self.zone].heroes.remove(self.hero)
-        player.fate_discard.append(self.hero)
-        player.vanquish_history.append((self.hero, self.zone))
-        for item in self.hero.items:
+        zone.remove_card(hero)
+        player.fate_discard.append(hero)
+        player.vanquish_history.append((hero, self.zone))
+        for item in hero.items:
             player.fate_discard.append(item)
-        self.hero.items = []
+        hero.items = []
         
-        if len(player.board[self.zone].heroes) == 0:
-            for action in player.board[self.zone].actions_blockable:
-                if type(action) is PowerAction and action not in game_state.actions_used:
+        if len(zone.heroes) == 0:
+            for action in zone.actions_blockable:
+                if type(action) is PowerAction and not game_state.actions_used & action.bit:
                     player.power += action.power
                     print("freed power")
-                    actions_used.append(action)
+                    game_state.actions_used |= action.bit
         
     def __str__(self):
         if len(self.allies) == 1:
@@ -177,13 +386,8 @@ class VanquishMove(Move):
         else:
             return f"Vanquish {self.hero.name} with {len(self.allies)} allies"
         
-    def __eq__(self, other):
-        if type(self) is type(other) and self.hero == other.hero and self.zone == other.zone:
-            return collections.Counter(self.allies) == collections.Counter(other.allies)
-        return False
-        
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def make_key(self):
+        return (type(self).__name__, self.hero_key, self.zone, tuple(sorted(self.ally_keys)))
         
 class FateMove(Move):
 
@@ -200,14 +404,14 @@ class FateMove(Move):
             heroes = 0
             # TODO: make this something like: if fate_card.must_play_to_zone > -1:
             if fate_card.name == "Peter Pan":
-                target_player.board[3].heroes.append(fate_card)
+                target_player.board[3].heroes.append(fate_card.Clone())
                 return
             for zone in target_player.board:
                 heroes += len(zone.heroes)
             if (heroes >= 1 and len(target_player.board[3].heroes) == 0) or heroes == 1:
-                target_player.board[3].heroes.append(fate_card)
+                target_player.board[3].heroes.append(fate_card.Clone())
             else:
-                target_player.board_position.heroes.append(fate_card)
+                target_player.board_position.heroes.append(fate_card.Clone())
         else:
             if fate_card.card_type == CardType.EFFECT:
                 fate_card.play(target_player, game_state)
@@ -216,8 +420,5 @@ class FateMove(Move):
     def __str__(self):
         return f"Fate player {self.target_player_index}"
         
-    def __eq__(self, other):
-        return type(self) is type(other) and self.target_player_index == other.target_player_index
-        
-    def __ne__(self, other):
-        return type(self) is not type(other) or self.target_player_index != other.target_player_index
\ No newline at end of file
+    def make_key(self):
+        return (type(self).__name__, self.target_player_index)
\ No newline at end of file
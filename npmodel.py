@@ -0,0 +1,206 @@
+""" Run the small Keras networks with NumPy alone. export_model() writes the weights of a trained model to a
+    compact .npz file and load_numpy_model() reads it back as a NumpyModel, which offers predict() and
+    __call__() like the Keras model, so agents and searches can use it in its place without TensorFlow:
+
+        python npmodel.py Con4_Conv_Recent.h5 Con4_Conv_Recent.npz
+        agents = [AlphaMCTSAgent(model=load_numpy_model("Con4_Conv_Recent.npz")), Agent()]
+
+    Only what get_model() and init_model_villainous() build is supported: Dense, Conv2D (valid padding),
+    MaxPooling2D and Flatten layers with relu or linear activations.
+"""
+import argparse
+import json
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+ACTIVATIONS = {
+    "linear": None,
+    "relu": lambda x: np.maximum(x, 0, out=x),
+}
+
+def window_index(shape, size, strides):
+    """ For inputs of shape (height, width, channels), the index into a flattened input of each element
+        of each window, as an (output height, output width, channels, window height * window width) array.
+        Gathering with it is much cheaper than building the windows of a small input on every call.
+    """
+    cells = np.arange(np.prod(shape)).reshape(shape)
+    windows = sliding_window_view(cells, size, axis=(0, 1))[::strides[0], ::strides[1]]
+    return windows.reshape(windows.shape[:3] + (-1,))
+
+def activation_function(name):
+    if name not in ACTIVATIONS:
+        raise ValueError(f"Unsupported activation {name!r}, expected one of {sorted(ACTIVATIONS)}")
+    return ACTIVATIONS[name]
+
+class Dense:
+
+    def __init__(self, kernel, bias, activation="linear"):
+        self.kernel = np.ascontiguousarray(kernel, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.activation = activation
+        self.apply = activation_function(activation)
+
+    def __call__(self, x):
+        x = x @ self.kernel
+        x += self.bias
+        return x if self.apply is None else self.apply(x)
+
+    def config(self):
+        return {"activation": self.activation}, {"kernel": self.kernel, "bias": self.bias}
+
+class Conv2D:
+    """ A channels-last convolution without padding, as a matrix product over the windows of the input.
+    """
+
+    def __init__(self, kernel, bias, strides=(1, 1), activation="linear"):
+        kernel = np.asarray(kernel, dtype=np.float32)
+        self.kernel = kernel
+        self.size = kernel.shape[:2]
+        self.strides = tuple(strides)
+        # (height, width, channels, filters) as Keras stores it, ordered to match the windows' (channels, height, width)
+        self.matrix = np.ascontiguousarray(kernel.transpose(2, 0, 1, 3).reshape(-1, kernel.shape[3]))
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.activation = activation
+        self.apply = activation_function(activation)
+        self.index = {} # input shape -> (window_index of it, output height and width)
+
+    def __call__(self, x):
+        index = self.index.get(x.shape[1:])
+        if index is None:
+            windows = window_index(x.shape[1:], self.size, self.strides)
+            index = self.index[x.shape[1:]] = (windows.reshape(windows.shape[0] * windows.shape[1], -1), windows.shape[:2])
+        windows, (height, width) = index
+        x = x.reshape(len(x), -1)[:, windows] @ self.matrix
+        x += self.bias
+        x = x.reshape(len(x), height, width, -1)
+        return x if self.apply is None else self.apply(x)
+
+    def config(self):
+        return {"strides": list(self.strides), "activation": self.activation}, {"kernel": self.kernel, "bias": self.bias}
+
+class MaxPooling2D:
+
+    def __init__(self, pool_size=(2, 2), strides=None):
+        self.pool_size = tuple(pool_size)
+        self.strides = tuple(strides) if strides else self.pool_size
+
+    def __call__(self, x):
+        (pool_height, pool_width), (stride_height, stride_width) = self.pool_size, self.strides
+        height = (x.shape[1] - pool_height) // stride_height + 1
+        width = (x.shape[2] - pool_width) // stride_width + 1
+        # The maximum of the strided views of each position in the window
+        out = None
+        for i in range(pool_height):
+            for j in range(pool_width):
+                view = x[:, i:i + stride_height * (height - 1) + 1:stride_height, j:j + stride_width * (width - 1) + 1:stride_width]
+                out = view.copy() if out is None else np.maximum(out, view, out=out)
+        return out
+
+    def config(self):
+        return {"pool_size": list(self.pool_size), "strides": list(self.strides)}, {}
+
+class Flatten:
+
+    def __call__(self, x):
+        return x.reshape(len(x), -1)
+
+    def config(self):
+        return {}, {}
+
+LAYERS = {layer.__name__: layer for layer in (Dense, Conv2D, MaxPooling2D, Flatten)}
+
+class NumpyModel:
+    """ A feed-forward stack of layers evaluated with NumPy, in float32. Inputs are reshaped to input_shape
+        (one sample's shape, as the Keras model declared it) when one is given.
+    """
+
+    def __init__(self, layers, input_shape=None):
+        self.layers = layers
+        self.input_shape = None if input_shape is None else tuple(input_shape)
+
+    def predict(self, inputs, verbose=0):
+        x = np.asarray(inputs, dtype=np.float32)
+        if self.input_shape is not None:
+            x = x.reshape((len(x),) + self.input_shape)
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+    def __call__(self, inputs, training=False):
+        return self.predict(inputs)
+
+    def save(self, path):
+        """ Write the model to path as an .npz of its weights, named "<layer index>.<weight>", and a JSON
+            description of its layers.
+        """
+        spec = {"input_shape": None if self.input_shape is None else list(self.input_shape), "layers": []}
+        arrays = {}
+        for i, layer in enumerate(self.layers):
+            config, weights = layer.config()
+            spec["layers"].append({"type": type(layer).__name__, "config": config})
+            for name, array in weights.items():
+                arrays[f"{i}.{name}"] = array
+        np.savez(path, spec=np.array(json.dumps(spec)), **arrays)
+
+def load_numpy_model(path):
+    """ Read a model written by NumpyModel.save() or export_model().
+    """
+    with np.load(path, allow_pickle=False) as data:
+        spec = json.loads(str(data["spec"]))
+        layers = []
+        for i, layer in enumerate(spec["layers"]):
+            weights = {name.split(".", 1)[1]: data[name] for name in data.files if name.startswith(f"{i}.")}
+            layers.append(LAYERS[layer["type"]](**layer["config"], **weights))
+    return NumpyModel(layers, spec["input_shape"])
+
+def convert_keras_model(model):
+    """ The NumpyModel computing the same function as a Keras Sequential model.
+    """
+    layers = []
+    for layer in model.layers:
+        kind = type(layer).__name__
+        config = layer.get_config()
+        if kind in ("InputLayer", "Dropout"):
+            # Nothing to do at inference time
+            continue
+        if kind == "Dense":
+            kernel, bias = layer.get_weights()
+            layers.append(Dense(kernel, bias, config["activation"]))
+        elif kind == "Conv2D":
+            if config["padding"] != "valid" or tuple(config["dilation_rate"]) != (1, 1) or config.get("data_format", "channels_last") != "channels_last":
+                raise ValueError(f"Only channels-last Conv2D layers with valid padding and no dilation are supported, not {config}")
+            kernel, bias = layer.get_weights()
+            layers.append(Conv2D(kernel, bias, config["strides"], config["activation"]))
+        elif kind == "MaxPooling2D":
+            if config["padding"] != "valid":
+                raise ValueError(f"Only MaxPooling2D layers with valid padding are supported, not {config}")
+            layers.append(MaxPooling2D(config["pool_size"], config["strides"]))
+        elif kind == "Flatten":
+            layers.append(Flatten())
+        else:
+            raise ValueError(f"Unsupported layer {kind}, expected one of InputLayer, Dropout, {', '.join(LAYERS)}")
+    input_shape = getattr(model, "input_shape", None)
+    return NumpyModel(layers, None if input_shape is None else input_shape[1:])
+
+def export_model(model, path):
+    """ Write a Keras model, or the model saved at model (an .h5 file or SavedModel directory such as
+        RegModel_3-22), to path for load_numpy_model(). Return the NumpyModel written.
+    """
+    if isinstance(model, str):
+        # Only exporting needs TensorFlow
+        from tensorflow.keras.models import load_model
+        model = load_model(model)
+    numpy_model = convert_keras_model(model)
+    numpy_model.save(path)
+    return numpy_model
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the weights of a saved Keras model for npmodel.load_numpy_model().")
+    parser.add_argument("model", help="an .h5 file or SavedModel directory")
+    parser.add_argument("path", help="the .npz file to write")
+    args = parser.parse_args()
+    numpy_model = export_model(args.model, args.path)
+    print(f"{len(numpy_model.layers)} layers written to {args.path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+""" Generate Connect Four training data by self-play across a process pool. Each worker builds its agents once
+    and plays whole games, sending back every searched position labelled with the game's result and the search's
+    visit-count policy; this process is the only writer, streaming the samples into a shard directory (see
+    dataset.SampleWriter) that get_model(train=True, data=...) can train from:
+
+        python selfplay.py --games 10000 --workers 8 --agents ismcts ismcts --out data/con4
+
+    With --capacity the samples go through a dataset.ReplayBuffer instead, which merges repeated positions and
+    keeps at most that many, and the directory is rewritten with its contents at the end.
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import Pool
+import numpy as np
+from agents import Agent, ISMCTSAgent, AlphaMCTSAgent
+from connectfour import ConnectFourState, canonical_sample
+from dataset import SampleWriter, ReplayBuffer, ShardedDataset, read_index
+from monte import SelfPlayGame, get_model
+from simulate import GameSeed
+
+SelfPlayResult = namedtuple("SelfPlayResult", ["index", "winner", "first_player", "features", "values", "policies", "seconds"])
+
+class GameSamples:
+    """ Holds the samples of one game in a worker, so they can be sent to the writer as three arrays at once.
+        Samples are kept in their canonical orientation (see canonical_sample), so that a ReplayBuffer merges
+        mirrored positions; get_model trains on both orientations.
+    """
+
+    def __init__(self):
+        self.features = []
+        self.values = []
+        self.policies = []
+
+    def add(self, features, value, policy):
+        features, policy = canonical_sample(features, policy)
+        self.features.append(features)
+        self.values.append(value)
+        self.policies.append(policy)
+
+    def arrays(self):
+        if not self.values:
+            return np.zeros((0, 42), dtype=np.float32), np.zeros(0, dtype=np.float32), np.zeros((0, 7), dtype=np.float32)
+        return np.stack(self.features), np.asarray(self.values, dtype=np.float32), np.stack(self.policies)
+
+def MakeAgents(names, iterations=500, model_type=1, batch_size=8, transpositions=100000, engine="numpy"):
+    """ The agents named in names (see AGENTS), one per seat. Alpha agents share a model, loaded once,
+        by default as an npmodel.NumpyModel so that workers never import TensorFlow (see get_model).
+    """
+    model = None
+    agents = []
+    for name in names:
+        if name == "alpha" and model is None:
+            model = get_model(model_type, engine=engine)
+        agents.append(AGENTS[name](iterations=iterations, model=model, batch_size=batch_size, transpositions=transpositions))
+    return agents
+
+AGENTS = {
+    "ismcts": lambda iterations, **options: ISMCTSAgent(iterations=iterations),
+    "alpha": lambda iterations, model, batch_size, transpositions: AlphaMCTSAgent(iterations=iterations, model=model, batch_size=batch_size,
+                                                                                  transpositions=transpositions),
+    "random": lambda **options: Agent(),
+}
+
+def PlaySelfPlayGame(index, agents, seed=0):
+    """ Play game index of a batch between agents, player index % 2 moving first, and return a SelfPlayResult.
+    """
+    random.seed(GameSeed(seed, index))
+    np.random.seed(GameSeed(seed, index))
+    start = time.perf_counter()
+    state = ConnectFourState(starting_player=index % 2)
+    samples = GameSamples()
+    winner = SelfPlayGame(agents, state, recorder=samples, verbose=False)
+    features, values, policies = samples.arrays()
+    return SelfPlayResult(index, winner, index % 2, features, values, policies, time.perf_counter() - start)
+
+# The agents of a worker process, built once by _InitWorker and kept for all of its games
+_worker_agents = None
+
+def _InitWorker(names, options):
+    global _worker_agents
+    # Agents and searches print as they go; in a batch nobody reads it
+    sys.stdout = open(os.devnull, "w")
+    _worker_agents = MakeAgents(names, **options)
+
+def _PlaySelfPlayJob(job):
+    index, seed = job
+    return PlaySelfPlayGame(index, _worker_agents, seed)
+
+def SelfPlay(games, names, options=None, writer=None, workers=1, seed=0, chunksize=1):
+    """ Play games self-play games between the agents named in names (built by MakeAgents(names, **options) in
+        each worker) and yield their SelfPlayResults as they finish, writing their samples to writer if given.
+        Games run in a pool of workers processes, or in this process with one worker.
+    """
+    options = options or {}
+    jobs = ((index, seed) for index in range(games))
+    if workers > 1:
+        with Pool(workers, initializer=_InitWorker, initargs=(names, options)) as pool:
+            for result in pool.imap_unordered(_PlaySelfPlayJob, jobs, chunksize=chunksize):
+                _WriteSamples(writer, result)
+                yield result
+    else:
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                agents = MakeAgents(names, **options)
+            for index, seed in jobs:
+                with contextlib.redirect_stdout(devnull):
+                    result = PlaySelfPlayGame(index, agents, seed)
+                _WriteSamples(writer, result)
+                yield result
+
+def _WriteSamples(writer, result):
+    if writer is not None:
+        for features, value, policy in zip(result.features, result.values, result.policies):
+            writer.add(features, value, policy)
+
+class SelfPlayStats:
+    """ Running totals over the SelfPlayResults of a batch: results by seat and sample throughput.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.games = 0
+        self.wins = [0, 0]
+        self.draws = 0
+        self.samples = 0
+        self.start = time.perf_counter()
+
+    def add(self, result):
+        self.games += 1
+        self.samples += len(result.values)
+        if result.winner is None:
+            self.draws += 1
+        else:
+            self.wins[result.winner] += 1
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return (f"{self.games} games ({self.wins[0]}-{self.wins[1]}, {self.draws} draws), {self.samples} samples, "
+                f"{self.samples / elapsed:.1f} samples/sec, {self.samples / elapsed / self.workers:.1f} samples/sec per worker")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Connect Four training samples by self-play.")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--agents", nargs=2, default=["ismcts", "ismcts"], choices=sorted(AGENTS), help="the agent of each player")
+    parser.add_argument("--iterations", type=int, default=500, help="search iterations per move")
+    parser.add_argument("--model-type", type=int, default=1, help="the get_model() network of alpha agents")
+    parser.add_argument("--batch-size", type=int, default=8, help="leaves evaluated per model call by alpha agents")
+    parser.add_argument("--transpositions", type=int, default=100000, help="evaluations kept for reuse by alpha agents")
+    parser.add_argument("--engine", default="numpy", choices=["numpy", "keras"], help="how alpha agents evaluate their model")
+    parser.add_argument("--out", default="selfplay", help="the shard directory to write (appended to if it exists)")
+    parser.add_argument("--shard-size", type=int, default=4096)
+    parser.add_argument("--capacity", type=int, default=None, help="keep at most this many distinct positions in --out")
+    parser.add_argument("--eviction", default="fifo", choices=["fifo", "priority"], help="which position --capacity evicts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report-every", type=int, default=100)
+    args = parser.parse_args()
+
+    options = {"iterations": args.iterations, "model_type": args.model_type, "batch_size": args.batch_size, "transpositions": args.transpositions,
+               "engine": args.engine}
+    stats = SelfPlayStats(args.workers)
+    if args.capacity is not None:
+        writer = ReplayBuffer(args.capacity, eviction=args.eviction)
+        if read_index(args.out) is not None:
+            writer.extend(ShardedDataset(args.out))
+    else:
+        writer = SampleWriter(args.out, shard_size=args.shard_size)
+    for result in SelfPlay(args.games, args.agents, options, writer, workers=args.workers, seed=args.seed):
+        stats.add(result)
+        if stats.games % args.report_every == 0:
+            print(stats.summary(), flush=True)
+    if stats.games % args.report_every != 0:
+        print(stats.summary())
+    if args.capacity is not None:
+        writer.save(args.out, shard_size=args.shard_size)
+        print(f"{len(writer)} positions kept: {writer.merged} of {writer.added} samples merged, {writer.evicted} evicted")
+    else:
+        writer.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+""" Play large batches of Villainous games between configurable agents and villains, without printing
+    the games, across a process pool. Results are aggregated as games finish:
+
+        python simulate.py --games 10000 --workers 8 --villains Villain CaptainHook --agents ismcts random
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+from collections import Counter, namedtuple
+from copy import deepcopy
+from multiprocessing import Pool
+import numpy as np
+import hook
+from game import VillainousState, PlayerState, Villain, encode_cards
+from agents import Agent, ISMCTSAgent
+from monte import ObserveMove, CheckCloneMove
+
+# winner and first_player are indexes into the lineup of villains (and agents) a batch was given, not seats
+GameResult = namedtuple("GameResult", ["index", "winner", "first_player", "turns", "moves", "seconds"])
+
+def PlayHeadlessGame(agents, state, max_turns=None, check_clones=False):
+    """ Play state out between agents (one per player) and return (winner, moves made).
+        Unlike PlayGame nothing is printed here; the winner is None if nobody won within max_turns.
+        With check_clones every move is also made on a clone of the state, see monte.CheckCloneMove.
+    """
+    moves = 0
+    while state.GetMoves() and (max_turns is None or state.turn <= max_turns):
+        m = agents[state.playerToMove].GetMove(state)
+        if isinstance(m, tuple):
+            # Agents in agents.py return (move, node)
+            m = m[0]
+        if check_clones:
+            CheckCloneMove(state, m)
+        else:
+            state.DoMove(m)
+        ObserveMove(agents, state, m)
+        moves += 1
+        if state.IsTerminal():
+            break
+    winner = None
+    for p in range(state.numberOfPlayers):
+        if state.GetResult(p) > 0:
+            winner = p
+    return winner, moves
+
+def GameSeed(seed, index):
+    """ The seed of game index in a batch, so a batch plays the same games however they are spread over workers.
+    """
+    return (seed * 1000003 + index) % (2 ** 32)
+
+def PlayMatchupGame(index, agents, villains, seed=0, max_turns=None, check_clones=False):
+    """ Play game index of a batch: a fresh copy of agents plays villains (agents[i] playing villains[i]).
+        The lineup is rotated from game to game to choose who moves first, and seated in that order, since
+        VillainousState gives the later seats their extra starting power. Return a GameResult.
+    """
+    random.seed(GameSeed(seed, index))
+    np.random.seed(GameSeed(seed, index))
+    start = time.perf_counter()
+    # order[seat] is the lineup index of the villain and agent in that seat
+    order = [(index + seat) % len(villains) for seat in range(len(villains))]
+    agents = deepcopy([agents[i] for i in order])
+    players = [PlayerState(f"Player {i}", Villain(villains[i])) for i in order]
+    state = VillainousState(players)
+    state.card_encoding = encode_cards(state)
+    winner, moves = PlayHeadlessGame(agents, state, max_turns, check_clones)
+    return GameResult(index, None if winner is None else order[winner], order[0], state.turn, moves, time.perf_counter() - start)
+
+def _QuietWorker():
+    # Agents and searches print as they go; in a batch nobody reads it
+    sys.stdout = open(os.devnull, "w")
+
+def _PlayMatchupJob(job):
+    return PlayMatchupGame(*job)
+
+def SimulateGames(games, agents, villains=("Villain", "Villain"), workers=1, seed=0, max_turns=None, chunksize=4, check_clones=False):
+    """ Play games games of agents against each other as villains and yield their GameResults as they finish,
+        in a pool of workers processes (or in this process with one worker).
+    """
+    jobs = ((index, agents, villains, seed, max_turns, check_clones) for index in range(games))
+    if workers > 1:
+        with Pool(workers, initializer=_QuietWorker) as pool:
+            yield from pool.imap_unordered(_PlayMatchupJob, jobs, chunksize=chunksize)
+    else:
+        with open(os.devnull, "w") as devnull:
+            for job in jobs:
+                with contextlib.redirect_stdout(devnull):
+                    result = _PlayMatchupJob(job)
+                yield result
+
+class MatchupStats:
+    """ Running totals over the GameResults of a batch: wins of each villain and agent, split by whether
+        it moved first, game lengths and throughput. The same villain and agent in more than one place of
+        the lineup (as in a mirror match) are counted together.
+    """
+
+    def __init__(self, villains, agents):
+        self.names = [f"{villain} ({agent})" for villain, agent in zip(villains, agents)]
+        self.games = 0
+        self.draws = 0
+        self.played = Counter()
+        self.wins = Counter()
+        self.first = Counter() # games in which it moved first
+        self.first_wins = Counter()
+        self.turns = 0
+        self.moves = 0
+        self.game_seconds = 0
+        self.start = time.perf_counter()
+
+    def add(self, result):
+        self.games += 1
+        self.played.update(self.names)
+        self.first[self.names[result.first_player]] += 1
+        if result.winner is None:
+            self.draws += 1
+        else:
+            self.wins[self.names[result.winner]] += 1
+            if result.winner == result.first_player:
+                self.first_wins[self.names[result.winner]] += 1
+        self.turns += result.turns
+        self.moves += result.moves
+        self.game_seconds += result.seconds
+
+    def win_rate(self, name):
+        return self.wins[name] / self.played[name] if self.played[name] else 0
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        lines = [f"{self.games} games, {self.draws} unfinished, {self.turns / max(self.games, 1):.1f} turns "
+                 f"and {self.moves / max(self.games, 1):.1f} moves per game, {self.moves / max(elapsed, 1e-9):.0f} moves/sec, "
+                 f"{self.games / max(elapsed, 1e-9):.2f} games/sec"]
+        for name in dict.fromkeys(self.names):
+            second = self.played[name] - self.first[name]
+            second_wins = self.wins[name] - self.first_wins[name]
+            lines.append(f"  {name}: {self.wins[name]} wins in {self.played[name]} ({self.win_rate(name) * 100:.1f}%), "
+                         f"going first {self.first_wins[name]}-{self.first[name] - self.first_wins[name]}, "
+                         f"going second {second_wins}-{second - second_wins}")
+        return "\n".join(lines)
+
+AGENTS = {
+    "ismcts": lambda args: ISMCTSAgent(iterations=args.iterations, rollout_moves=args.rollout_moves),
+    "random": lambda args: Agent(),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a batch of Villainous games without printing them.")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--villains", nargs="+", default=["Villain", "Villain"], help="the villains playing, each seated first in turn")
+    parser.add_argument("--agents", nargs="+", default=["ismcts", "ismcts"], choices=sorted(AGENTS), help="the agent playing each of --villains")
+    parser.add_argument("--iterations", type=int, default=500, help="ISMCTS iterations per move")
+    parser.add_argument("--max-turns", type=int, default=None, help="count games still going after this many turns as unfinished")
+    parser.add_argument("--rollout-moves", type=int, default=1000,
+                        help="score ISMCTS rollouts still going after this many moves as draws (random games take about 50)")
+    parser.add_argument("--check-clones", action="store_true", help="also make every move on a clone of the game, and stop if they differ")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report-every", type=int, default=100)
+    args = parser.parse_args()
+    if len(args.agents) != len(args.villains):
+        parser.error("give one agent per villain")
+
+    agents = [AGENTS[name](args) for name in args.agents]
+    stats = MatchupStats(args.villains, args.agents)
+    for result in SimulateGames(args.games, agents, args.villains, workers=args.workers, seed=args.seed, max_turns=args.max_turns,
+                                check_clones=args.check_clones):
+        stats.add(result)
+        if stats.games % args.report_every == 0:
+            print(stats.summary(), flush=True)
+    if stats.games % args.report_every != 0:
+        print(stats.summary())
+
+if __name__ == "__main__":
+    main()
@@ -74,6 +74,7 @@ class UnoState(GameState):
         st = UnoState(self.numberOfPlayers, game_init=False)
         st.turn = self.turn
         st.gameRound = self.gameRound
+        st.playerToMove = self.playerToMove
         st.turnDirection = self.turnDirection
         st.scores = copy(self.scores)
         st.hands = deepcopy(self.hands)
@@ -85,10 +86,16 @@ class UnoState(GameState):
     def CloneAndRandomize(self, observer):
         """ Create a deep clone of this game state, randomizing any information not visible to the specified observer player.
         """
-        st = self.Clone()             
+        st = self.Clone()
+        st.Randomize(observer)
+        return st
+
+    def Randomize(self, observer):
+        """ Randomize, in place, any information not visible to the specified observer player.
+        """
         #print(f"Randomizing from {observer}'s perspective")
         # The observer can see their own hand and the discard pile
-        unseenCards = self.deck
+        unseenCards = copy(self.deck)
         for player in range(0, self.numberOfPlayers):
             if player != observer:
                 unseenCards.extend(self.hands[player])
@@ -102,9 +109,7 @@ class UnoState(GameState):
                 unseenCards = unseenCards[numCards:]
         
         self.deck = unseenCards
-        
-        #print(f"deck length after shuffle: {len(self.deck)}")       
-        return st
+        #print(f"deck length after shuffle: {len(self.deck)}")
     
     def GetNextPlayer(self, p):
         """ Return the player to the left of the specified player """
@@ -192,6 +197,20 @@ class UnoState(GameState):
              
         return self
 
+    def DoUndoableMove(self, move):
+        """ Carry out the given move like DoMove, and return a token that UndoMove can use to take it back.
+            The token is a shallow copy of everything a move can change; the cards themselves are never modified.
+        """
+        token = (self.turn, self.gameRound, self.playerToMove, self.turnDirection, copy(self.scores),
+                 [copy(hand) for hand in self.hands], copy(self.deck), copy(self.discard))
+        self.DoMove(move)
+        return token
+
+    def UndoMove(self, token):
+        """ Restore the state from before the DoUndoableMove call that returned token.
+        """
+        self.turn, self.gameRound, self.playerToMove, self.turnDirection, self.scores, self.hands, self.deck, self.discard = token
+
     
     def GetMoves(self):
         """ Get all possible moves from this state.
@@ -350,6 +369,12 @@ class Card:
     def __ne__(self, other):
         return not self.__eq__(other)#type(self) is not type(other) self.color != other.color or self.value != other.value
 
+    def __hash__(self):
+        # Wild cards compare equal whatever color was chosen, so they must hash the same too
+        if self.value == CardValue.WILD or self.value == CardValue.WILD_DRAW_4:
+            return hash(self.value)
+        return hash((self.color, self.value))
+
 def main():    
     agents = [ISMCTSAgent(), Agent(), Agent()]
 